@@ -1,16 +1,21 @@
 import os
 import shutil
+import time
 
 import click
 import numpy as np
+import pandas as pd
 from sklearn.cross_validation import ShuffleSplit
 from deepsense import neptune
 
+from models import WordCuDNNGRU, WordCuDNNLSTM
 from pipeline_config import SOLUTION_CONFIG, Y_COLUMNS
 from pipelines import PIPELINES
 from preprocessing import split_train_data
-from utils import init_logger, get_logger, read_params, read_data, read_predictions, multi_roc_auc_score, \
-    create_submission
+from steps.executor import Executor, format_plan, merge_steps
+from steps.keras.models import EmbeddingsMatrix
+from utils import init_logger, get_logger, read_params, read_data, read_data_chunks, read_predictions, \
+    multi_roc_auc_score, create_submission
 
 logger = get_logger()
 ctx = neptune.Context()
@@ -31,14 +36,25 @@ def train_valid_split(validation_size):
 
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
-def train_pipeline(pipeline_name):
-    _train_pipeline(pipeline_name)
+@click.option('-f', '--frozen_step', help='step fitted before, e.g. with fit_step_chunked, used as it is',
+              multiple=True, required=False)
+def train_pipeline(pipeline_name, frozen_step):
+    _train_pipeline(pipeline_name, frozen_step)
 
 
-def _train_pipeline(pipeline_name):
+def _train_pipeline(pipeline_name, frozen_step_names=()):
     if bool(params.overwrite) and os.path.isdir(params.experiment_dir):
         shutil.rmtree(params.experiment_dir)
 
+    data = _get_train_data()
+
+    pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
+    for step_name in frozen_step_names:
+        pipeline.get_step(step_name).freeze_transformer = True
+    pipeline.fit_transform(data, num_workers=params.num_workers, cache_size_limit=SOLUTION_CONFIG.env.cache_size_limit)
+
+
+def _get_train_data():
     train = read_data(data_dir=params.data_dir, filename='train_split.csv')
     valid = read_data(data_dir=params.data_dir, filename='valid_split.csv')
 
@@ -51,9 +67,7 @@ def _train_pipeline(pipeline_name):
                                'train_mode': True,
                                },
             }
-
-    pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
-    output = pipeline.fit_transform(data)
+    return data
 
 
 @action.command()
@@ -64,7 +78,23 @@ def evaluate_pipeline(pipeline_name):
 
 def _evaluate_pipeline(pipeline_name):
     valid = read_data(data_dir=params.data_dir, filename='valid_split.csv')
+    data = _get_evaluation_data(valid)
+
+    pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
+    output = pipeline.transform(data, num_workers=params.num_workers,
+                                cache_size_limit=SOLUTION_CONFIG.env.cache_size_limit)
+    y_true = valid[Y_COLUMNS].values
+    y_pred = output['y_pred']
+
+    create_submission(params.experiment_dir, '{}_predictions_valid.csv'.format(pipeline_name), valid, y_pred, Y_COLUMNS,
+                      logger)
+
+    score = multi_roc_auc_score(y_true, y_pred)
+    logger.info('Score on validation is {}'.format(score))
+    ctx.channel_send('Final Validation Score ROC_AUC', 0, score)
+
 
+def _get_evaluation_data(valid):
     data = {'input': {'meta': valid,
                       'meta_valid': None,
                       'train_mode': False,
@@ -74,18 +104,92 @@ def _evaluate_pipeline(pipeline_name):
                                'train_mode': False,
                                },
             }
+    return data
+
+
+@action.command()
+@click.argument('pipeline_names', nargs=-1)
+def train_pipelines(pipeline_names):
+    _train_pipelines(pipeline_names)
+
+
+def _train_pipelines(pipeline_names):
+    if bool(params.overwrite) and os.path.isdir(params.experiment_dir):
+        shutil.rmtree(params.experiment_dir)
+
+    data = _get_train_data()
+
+    pipelines = merge_steps([PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG) for pipeline_name in pipeline_names])
+    Executor(params.num_workers, SOLUTION_CONFIG.env.cache_size_limit).run(pipelines, data, is_fit=True)
+
+
+def _evaluate_pipelines(pipeline_names):
+    valid = read_data(data_dir=params.data_dir, filename='valid_split.csv')
+    data = _get_evaluation_data(valid)
+
+    pipelines = merge_steps(
+        [PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG) for pipeline_name in pipeline_names])
+    outputs = Executor(params.num_workers, SOLUTION_CONFIG.env.cache_size_limit).run(pipelines, data, is_fit=False)
 
-    pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
-    output = pipeline.transform(data)
     y_true = valid[Y_COLUMNS].values
-    y_pred = output['y_pred']
+    for pipeline_name, pipeline in zip(pipeline_names, pipelines):
+        y_pred = outputs[pipeline.name]['y_pred']
 
-    create_submission(params.experiment_dir, '{}_predictions_valid.csv'.format(pipeline_name), valid, y_pred, Y_COLUMNS,
-                      logger)
+        create_submission(params.experiment_dir, '{}_predictions_valid.csv'.format(pipeline_name), valid, y_pred,
+                          Y_COLUMNS, logger)
 
-    score = multi_roc_auc_score(y_true, y_pred)
-    logger.info('Score on validation is {}'.format(score))
-    ctx.channel_send('Final Validation Score ROC_AUC', 0, score)
+        score = multi_roc_auc_score(y_true, y_pred)
+        logger.info('Score of {} on validation is {}'.format(pipeline_name, score))
+        ctx.channel_send('{} Final Validation Score ROC_AUC'.format(pipeline_name), 0, score)
+
+
+def _predict_pipelines(pipeline_names):
+    test = read_data(data_dir=params.data_dir, filename='test.csv')
+    data = {'input': {'meta': test,
+                      'meta_valid': None,
+                      'train_mode': False,
+                      },
+            }
+
+    pipelines = merge_steps(
+        [PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG) for pipeline_name in pipeline_names])
+    outputs = Executor(params.num_workers, SOLUTION_CONFIG.env.cache_size_limit).run(pipelines, data, is_fit=False)
+
+    for pipeline_name, pipeline in zip(pipeline_names, pipelines):
+        y_pred = outputs[pipeline.name]['y_pred']
+        create_submission(params.experiment_dir, '{}_predictions_test.csv'.format(pipeline_name),
+                          test, y_pred, Y_COLUMNS, logger)
+
+
+@action.command()
+@click.argument('pipeline_names', nargs=-1)
+def train_evaluate_predict_pipelines(pipeline_names):
+    logger.info('training')
+    _train_pipelines(pipeline_names)
+    logger.info('evaluating')
+    _evaluate_pipelines(pipeline_names)
+    logger.info('predicting')
+    _predict_pipelines(pipeline_names)
+
+
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline to be planned', required=True)
+@click.option('-m', '--mode', help='train or inference', default='train', required=False)
+def plan_pipeline(pipeline_name, mode):
+    if mode == 'train':
+        data = _get_train_data()
+        is_fit = True
+    elif mode == 'inference':
+        valid = read_data(data_dir=params.data_dir, filename='valid_split.csv')
+        data = _get_evaluation_data(valid)
+        is_fit = False
+    else:
+        raise NotImplementedError("""only 'train' and 'inference' """)
+
+    pipeline = PIPELINES[pipeline_name][mode](SOLUTION_CONFIG)
+    ignore_cache = is_fit and bool(params.overwrite)
+    plan = Executor(params.num_workers).get_plan([pipeline], data, is_fit=is_fit, ignore_cache=ignore_cache)
+    logger.info('execution plan for {} {}\n{}'.format(pipeline_name, mode, format_plan(plan)))
 
 
 @action.command()
@@ -150,10 +254,12 @@ def train_evaluate_cv_pipeline(pipeline_name, model_level, stacking_mode, valida
             raise NotImplementedError("""only 'first' and 'second' """)
 
         pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
-        output = pipeline.fit_transform(data_train)
+        output = pipeline.fit_transform(data_train, num_workers=params.num_workers,
+                                        cache_size_limit=SOLUTION_CONFIG.env.cache_size_limit)
 
         pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
-        output = pipeline.transform(data_valid)
+        output = pipeline.transform(data_valid, num_workers=params.num_workers,
+                                    cache_size_limit=SOLUTION_CONFIG.env.cache_size_limit)
         y_pred = output['y_pred']
 
         score = multi_roc_auc_score(y_true, y_pred)
@@ -192,13 +298,98 @@ def _predict_pipeline(pipeline_name, model_level, stacking_mode):
         raise NotImplementedError("""only 'first' and 'second' """)
 
     pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
-    output = pipeline.transform(data)
+    output = pipeline.transform(data, num_workers=params.num_workers,
+                                cache_size_limit=SOLUTION_CONFIG.env.cache_size_limit)
     y_pred = output['y_pred']
 
     create_submission(params.experiment_dir, '{}_predictions_test.csv'.format(pipeline_name),
                       test, y_pred, Y_COLUMNS, logger)
 
 
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline to be used for prediction', required=True)
+@click.option('-c', '--chunksize', help='number of rows transformed at once', default=100000, required=False)
+def predict_pipeline_chunked(pipeline_name, chunksize):
+    pipeline = PIPELINES[pipeline_name]['inference'](SOLUTION_CONFIG)
+    executor = Executor()
+    plan = executor.get_chunk_plan([pipeline])
+
+    submission_filepath = os.path.join(params.experiment_dir, '{}_predictions_test.csv'.format(pipeline_name))
+    for i, test_chunk in enumerate(read_data_chunks(data_dir=params.data_dir, filename='test.csv',
+                                                    chunksize=chunksize)):
+        logger.info('predicting chunk {}'.format(i))
+        data_chunk = {'input': {'meta': test_chunk,
+                                'meta_valid': None,
+                                'train_mode': False,
+                                },
+                      }
+        output = executor.transform_chunk(plan, [pipeline], data_chunk)[pipeline.name]
+        submission = pd.DataFrame(output['y_pred'], columns=Y_COLUMNS)
+        submission.insert(0, 'id', test_chunk['id'].values)
+        submission.to_csv(submission_filepath, index=None, header=i == 0, mode='w' if i == 0 else 'a')
+    logger.info('submission saved to {}'.format(submission_filepath))
+
+
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline containing the step', required=True)
+@click.option('-s', '--step_name', help='step to be fitted, e.g. tfidf_word_vectorizer', required=True)
+@click.option('-f', '--filename', help='csv file in data_dir to fit on', default='train.csv', required=False)
+@click.option('-c', '--chunksize', help='number of rows fitted at once', default=100000, required=False)
+def fit_step_chunked(pipeline_name, step_name, filename, chunksize):
+    step = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG).get_step(step_name)
+
+    def get_data_chunks():
+        for meta_chunk in read_data_chunks(data_dir=params.data_dir, filename=filename, chunksize=chunksize):
+            yield {'input': {'meta': meta_chunk,
+                             'meta_valid': None,
+                             'train_mode': False,
+                             },
+                   }
+
+    Executor().fit_stream([step], get_data_chunks)
+    logger.info('train on it with train_pipeline -p {} -f {} and overwrite set to 0'.format(pipeline_name,
+                                                                                         step_name))
+
+
+@action.command()
+@click.option('-p', '--pipeline_name', help='pipeline whose pretrained embeddings are converted', required=True)
+def convert_embeddings(pipeline_name):
+    pipeline = PIPELINES[pipeline_name]['train'](SOLUTION_CONFIG)
+    embedding_steps = [step for step in pipeline.all_steps.values() if isinstance(step.transformer, EmbeddingsMatrix)]
+    if not embedding_steps:
+        raise ValueError('pipeline {} does not use pretrained embeddings'.format(pipeline_name))
+    for step in embedding_steps:
+        logger.info('converting {} to {}'.format(step.transformer.pretrained_filepath, step.transformer.store_dirpath))
+        step.transformer.convert_store()
+
+
+@action.command()
+@click.option('-n', '--network', help='recurrent network config, gru_network or lstm_network', default='gru_network',
+              required=False)
+@click.option('-r', '--row_nr', help='number of random rows predicted', default=10000, required=False)
+@click.option('--cudnn', help='time the CuDNN layers as well, needs a GPU', is_flag=True)
+def benchmark_rnn_backends(network, row_nr, cudnn):
+    model_class = {'gru_network': WordCuDNNGRU, 'lstm_network': WordCuDNNLSTM}[network]
+    model_params = SOLUTION_CONFIG[network]['architecture_config']['model_params']
+    batch_size = SOLUTION_CONFIG[network]['training_config']['batch_size']
+    X = np.random.randint(1, model_params['max_features'], (row_nr, model_params['maxlen']))
+
+    variants = [('cpu', False), ('cpu', True)]
+    if cudnn:
+        variants.insert(0, ('cudnn', False))
+    for rnn_backend, rnn_unroll in variants:
+        model = model_class(**SOLUTION_CONFIG[network])._build_model(**{**model_params,
+                                                                          'embedding_matrix': None,
+                                                                          'rnn_backend': rnn_backend,
+                                                                          'rnn_unroll': rnn_unroll})
+        model.predict(X[:batch_size], batch_size=batch_size)
+        start_time = time.time()
+        model.predict(X, batch_size=batch_size)
+        elapsed_time = time.time() - start_time
+        logger.info('{} backend, unroll {}: {:.1f}s, {:.0f} rows/s'.format(rnn_backend, rnn_unroll, elapsed_time,
+                                                                          row_nr / elapsed_time))
+
+
 @action.command()
 @click.option('-p', '--pipeline_name', help='pipeline to be trained', required=True)
 @click.option('-m', '--model_level', help='first or second level', default='first', required=True)
@@ -2,7 +2,7 @@ from keras import regularizers
 from keras.activations import relu
 from keras.callbacks import ModelCheckpoint, EarlyStopping
 from keras.layers import Input, Embedding, PReLU, Bidirectional, Lambda, \
-    CuDNNLSTM, CuDNNGRU, Conv1D, Dense, BatchNormalization, Dropout, SpatialDropout1D, \
+    CuDNNLSTM, CuDNNGRU, LSTM, GRU, Conv1D, Dense, BatchNormalization, Dropout, SpatialDropout1D, \
     GlobalMaxPool1D, GlobalAveragePooling1D, MaxPooling1D
 from keras.layers.merge import add, concatenate
 from keras.models import Model
@@ -10,7 +10,7 @@ from keras.optimizers import Adam
 
 from steps.keras.callbacks import NeptuneMonitor, ReduceLR
 from steps.keras.contrib import AttentionWeightedAverage
-from steps.keras.models import ClassifierXY
+from steps.keras.models import ClassifierXY, ClassifierBucketedXY
 from steps.utils import create_filepath
 
 
@@ -66,6 +66,25 @@ class PretrainedEmbeddingModel(BasicClassifier):
         return {'prediction_probability': predictions}
 
 
+class PretrainedEmbeddingRNN(ClassifierBucketedXY, PretrainedEmbeddingModel):
+    """
+    Note:
+        Recurrent models take sequences of any length and are fed length-bucketed batches by
+        ClassifierBucketedXY, while the optimizer, loss and callbacks come from BasicClassifier.
+    """
+
+    def fit(self, embedding_matrix, X, y, validation_data):
+        self.architecture_config['model_params']['embedding_matrix'] = embedding_matrix
+        return super().fit(X, y, validation_data)
+
+    def transform(self, embedding_matrix, X, y=None, validation_data=None):
+        return super().transform(X)
+
+    def load(self, filepath):
+        self.architecture_config['model_params'].setdefault('embedding_matrix', None)
+        return super().load(filepath)
+
+
 class WordSCNN(PretrainedEmbeddingModel):
     def _build_model(self, embedding_matrix, embedding_size, trainable_embedding, maxlen, max_features,
                      filter_nr, kernel_size, repeat_block, dense_size, repeat_dense,
@@ -103,7 +122,7 @@ class WordDPCNN(PretrainedEmbeddingModel):
                      use_prelu, use_batch_norm, batch_norm_first)
 
 
-class WordCuDNNLSTM(PretrainedEmbeddingModel):
+class WordCuDNNLSTM(PretrainedEmbeddingRNN):
     def _build_model(self, embedding_matrix, embedding_size, trainable_embedding,
                      maxlen, max_features,
                      unit_nr, repeat_block,
@@ -112,7 +131,8 @@ class WordCuDNNLSTM(PretrainedEmbeddingModel):
                      dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                      rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first,
+                     rnn_backend='cudnn', rnn_unroll=False):
         return cudnn_lstm(embedding_matrix, embedding_size, trainable_embedding,
                           maxlen, max_features,
                           unit_nr, repeat_block,
@@ -121,10 +141,11 @@ class WordCuDNNLSTM(PretrainedEmbeddingModel):
                           dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                           rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                           dense_kernel_reg_l2, dense_bias_reg_l2,
-                          use_prelu, use_batch_norm, batch_norm_first)
+                          use_prelu, use_batch_norm, batch_norm_first,
+                          rnn_backend, rnn_unroll)
 
 
-class WordCuDNNGRU(PretrainedEmbeddingModel):
+class WordCuDNNGRU(PretrainedEmbeddingRNN):
     def _build_model(self, embedding_matrix, embedding_size, trainable_embedding,
                      maxlen, max_features,
                      unit_nr, repeat_block,
@@ -133,7 +154,8 @@ class WordCuDNNGRU(PretrainedEmbeddingModel):
                      dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                      rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first,
+                     rnn_backend='cudnn', rnn_unroll=False):
         return cudnn_gru(embedding_matrix, embedding_size, trainable_embedding,
                          maxlen, max_features,
                          unit_nr, repeat_block,
@@ -142,7 +164,8 @@ class WordCuDNNGRU(PretrainedEmbeddingModel):
                          dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                          rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                          dense_kernel_reg_l2, dense_bias_reg_l2,
-                         use_prelu, use_batch_norm, batch_norm_first)
+                         use_prelu, use_batch_norm, batch_norm_first,
+                         rnn_backend, rnn_unroll)
 
 
 class StackerGru(BasicClassifier):
@@ -152,7 +175,8 @@ class StackerGru(BasicClassifier):
                      dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                      rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                      dense_kernel_reg_l2, dense_bias_reg_l2,
-                     use_prelu, use_batch_norm, batch_norm_first):
+                     use_prelu, use_batch_norm, batch_norm_first,
+                     rnn_backend='cudnn', rnn_unroll=False):
         input_predictions = Input(shape=(6, 16))
 
         x = _dropout(dropout_embedding, dropout_mode)(input_predictions)
@@ -163,7 +187,8 @@ class StackerGru(BasicClassifier):
                                  recurrent_reg_l2=rnn_recurrent_reg_l2,
                                  bias_reg_l2=rnn_bias_reg_l2,
                                  use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
-                                 dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu)(x)
+                                 dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu,
+                                 rnn_backend=rnn_backend, rnn_unroll=rnn_unroll)(x)
 
         predictions = _classification_block(dense_size=dense_size, repeat_dense=repeat_dense,
                                             max_pooling=max_pooling,
@@ -264,8 +289,9 @@ def cudnn_lstm(embedding_matrix, embedding_size, trainable_embedding,
                dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
                rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
                dense_kernel_reg_l2, dense_bias_reg_l2,
-               use_prelu, use_batch_norm, batch_norm_first):
-    input_text = Input(shape=(maxlen,))
+               use_prelu, use_batch_norm, batch_norm_first,
+               rnn_backend='cudnn', rnn_unroll=False):
+    input_text = Input(shape=(maxlen if rnn_unroll else None,))
     if embedding_matrix is not None:
         x = Embedding(max_features,
                       embedding_size,
@@ -283,7 +309,8 @@ def cudnn_lstm(embedding_matrix, embedding_size, trainable_embedding,
                              recurrent_reg_l2=rnn_recurrent_reg_l2,
                              bias_reg_l2=rnn_bias_reg_l2,
                              use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
-                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu)(x)
+                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu,
+                             rnn_backend=rnn_backend, rnn_unroll=rnn_unroll)(x)
 
     predictions = _classification_block(dense_size=dense_size, repeat_dense=repeat_dense,
                                         max_pooling=max_pooling,
@@ -306,8 +333,9 @@ def cudnn_gru(embedding_matrix, embedding_size, trainable_embedding,
               dropout_embedding, rnn_dropout, dense_dropout, dropout_mode,
               rnn_kernel_reg_l2, rnn_recurrent_reg_l2, rnn_bias_reg_l2,
               dense_kernel_reg_l2, dense_bias_reg_l2,
-              use_prelu, use_batch_norm, batch_norm_first):
-    input_text = Input(shape=(maxlen,))
+              use_prelu, use_batch_norm, batch_norm_first,
+              rnn_backend='cudnn', rnn_unroll=False):
+    input_text = Input(shape=(maxlen if rnn_unroll else None,))
     if embedding_matrix is not None:
         x = Embedding(max_features,
                       embedding_size,
@@ -325,7 +353,8 @@ def cudnn_gru(embedding_matrix, embedding_size, trainable_embedding,
                              recurrent_reg_l2=rnn_recurrent_reg_l2,
                              bias_reg_l2=rnn_bias_reg_l2,
                              use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
-                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu)(x)
+                             dropout=rnn_dropout, dropout_mode=dropout_mode, use_prelu=use_prelu,
+                             rnn_backend=rnn_backend, rnn_unroll=rnn_unroll)(x)
 
     predictions = _classification_block(dense_size=dense_size, repeat_dense=repeat_dense,
                                         max_pooling=max_pooling,
@@ -496,17 +525,25 @@ def _shape_matching_layer(filter_nr, use_prelu, kernel_reg_l2, bias_reg_l2):
 def _cudnn_lstm_block(unit_nr, return_sequences, bidirectional,
                       kernel_reg_l2, recurrent_reg_l2, bias_reg_l2,
                       use_batch_norm, batch_norm_first,
-                      dropout, dropout_mode, use_prelu):
+                      dropout, dropout_mode, use_prelu,
+                      rnn_backend='cudnn', rnn_unroll=False):
     def f(x):
-        gru_layer = CuDNNLSTM(uunits=unit_nr, return_sequences=return_sequences,
-                              kernel_regularizer=regularizers.l2(kernel_reg_l2),
-                              recurrent_regularizer=regularizers.l2(recurrent_reg_l2),
-                              bias_regularizer=regularizers.l2(bias_reg_l2)
-                              )
+        layer_params = {'units': unit_nr,
+                        'return_sequences': return_sequences,
+                        'kernel_regularizer': regularizers.l2(kernel_reg_l2),
+                        'recurrent_regularizer': regularizers.l2(recurrent_reg_l2),
+                        'bias_regularizer': regularizers.l2(bias_reg_l2),
+                        }
+        if rnn_backend == 'cudnn':
+            lstm_layer = CuDNNLSTM(**layer_params)
+        elif rnn_backend == 'cpu':
+            lstm_layer = LSTM(recurrent_activation='sigmoid', unroll=rnn_unroll, **layer_params)
+        else:
+            raise ValueError('rnn_backend should be cudnn or cpu, got {}'.format(rnn_backend))
         if bidirectional:
-            x = Bidirectional(gru_layer)(x)
+            x = Bidirectional(lstm_layer)(x)
         else:
-            x = gru_layer(x)
+            x = lstm_layer(x)
         x = _bn_relu_dropout_block(use_batch_norm=use_batch_norm, batch_norm_first=batch_norm_first,
                                    dropout=dropout, dropout_mode=dropout_mode,
                                    use_prelu=use_prelu)(x)
@@ -518,13 +555,29 @@ def _cudnn_lstm_block(unit_nr, return_sequences, bidirectional,
 def _cudnn_gru_block(unit_nr, return_sequences, bidirectional,
                      kernel_reg_l2, recurrent_reg_l2, bias_reg_l2,
                      use_batch_norm, batch_norm_first,
-                     dropout, dropout_mode, use_prelu):
+                     dropout, dropout_mode, use_prelu,
+                     rnn_backend='cudnn', rnn_unroll=False):
+    """
+    Note:
+        With rnn_backend='cpu' the block is built from a plain GRU with the gating of CuDNNGRU,
+        i.e. sigmoid recurrent activation and reset_after=True, so that the weights of a model
+        trained on GPU can be loaded into it, see steps.keras.utils.load_converted_weights.
+        rnn_unroll unrolls the recurrence, which needs a fixed number of timesteps.
+    """
+
     def f(x):
-        gru_layer = CuDNNGRU(units=unit_nr, return_sequences=return_sequences,
-                             kernel_regularizer=regularizers.l2(kernel_reg_l2),
-                             recurrent_regularizer=regularizers.l2(recurrent_reg_l2),
-                             bias_regularizer=regularizers.l2(bias_reg_l2)
-                             )
+        layer_params = {'units': unit_nr,
+                        'return_sequences': return_sequences,
+                        'kernel_regularizer': regularizers.l2(kernel_reg_l2),
+                        'recurrent_regularizer': regularizers.l2(recurrent_reg_l2),
+                        'bias_regularizer': regularizers.l2(bias_reg_l2),
+                        }
+        if rnn_backend == 'cudnn':
+            gru_layer = CuDNNGRU(**layer_params)
+        elif rnn_backend == 'cpu':
+            gru_layer = GRU(recurrent_activation='sigmoid', reset_after=True, unroll=rnn_unroll, **layer_params)
+        else:
+            raise ValueError('rnn_backend should be cudnn or cpu, got {}'.format(rnn_backend))
         if bidirectional:
             x = Bidirectional(gru_layer)(x)
         else:
@@ -12,7 +12,9 @@ X_COLUMNS = ['comment_text']
 Y_COLUMNS = ['toxic', 'severe_toxic', 'obscene', 'threat', 'insult', 'identity_hate']
 
 SOLUTION_CONFIG = AttrDict({
-    'env': {'cache_dirpath': params.experiment_dir},
+    'env': {'cache_dirpath': params.experiment_dir,
+            'cache_size_limit': int(float(params.cache_size_limit_gb) * 1024 ** 3),
+            },
     'xy_splitter': {'x_columns': X_COLUMNS,
                     'y_columns': Y_COLUMNS
                     },
@@ -21,34 +23,46 @@ SOLUTION_CONFIG = AttrDict({
                      'drop_multispaces': bool(params.drop_multispaces),
                      'all_lower_case': bool(params.all_lower_case),
                      'fill_na_with': params.fill_na_with,
-                     'deduplication_threshold': params.deduplication_threshold
+                     'deduplication_threshold': params.deduplication_threshold,
+                     'n_jobs': params.num_workers,
                      },
-    'bad_word_filter': {'word_list_filepath': params.bad_words_filepath},
+    'bad_word_filter': {'word_list_filepath': params.bad_words_filepath,
+                        'n_jobs': params.num_workers,
+                        },
     'char_tokenizer': {'char_level': True,
                        'maxlen': params.maxlen_char,
-                       'num_words': params.max_features_char
+                       'num_words': params.max_features_char,
+                       'n_jobs': params.num_workers,
                        },
     'word_tokenizer': {'char_level': False,
                        'maxlen': params.maxlen_words,
-                       'num_words': params.max_features_word
+                       'num_words': params.max_features_word,
+                       'n_jobs': params.num_workers,
                        },
     'tfidf_char_vectorizer': {'sublinear_tf': True,
                               'strip_accents': 'unicode',
                               'analyzer': 'char',
                               'token_pattern': r'\w{1,}',
                               'ngram_range': (1, params.char_ngram_max),
-                              'max_features': params.max_features_char
+                              'max_features': params.max_features_char,
+                              'use_hashing': bool(params.use_hashing_vectorizer),
+                              'hashing_n_features': params.hashing_n_features,
+                              'n_jobs': params.num_workers,
                               },
     'tfidf_word_vectorizer': {'sublinear_tf': True,
                               'strip_accents': 'unicode',
                               'analyzer': 'word',
                               'token_pattern': r'\w{1,}',
                               'ngram_range': (1, 1),
-                              'max_features': params.max_features_word
+                              'max_features': params.max_features_word,
+                              'use_hashing': bool(params.use_hashing_vectorizer),
+                              'hashing_n_features': params.hashing_n_features,
+                              'n_jobs': params.num_workers,
                               },
     'embeddings': {'pretrained_filepath': params.embedding_filepath,
                    'max_features': params.max_features_word,
-                   'embedding_size': params.word_embedding_size
+                   'embedding_size': params.word_embedding_size,
+                   'store_dir': params.embedding_store_dir,
                    },
     'dpcnn_network': {
         'architecture_config': {'model_params': {'max_features': params.max_features_word,
@@ -167,6 +181,8 @@ SOLUTION_CONFIG = AttrDict({
                                                  'use_prelu': bool(params.use_prelu),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
+                                                 'rnn_backend': params.rnn_backend,
+                                                 'rnn_unroll': bool(params.rnn_unroll),
                                                  },
                                 'optimizer_params': {'lr': params.lr,
                                                      'momentum': params.momentum,
@@ -212,6 +228,8 @@ SOLUTION_CONFIG = AttrDict({
                                                  'use_prelu': bool(params.use_prelu),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
+                                                 'rnn_backend': params.rnn_backend,
+                                                 'rnn_unroll': bool(params.rnn_unroll),
                                                  },
                                 'optimizer_params': {'lr': params.lr,
                                                      'momentum': params.momentum,
@@ -297,6 +315,8 @@ SOLUTION_CONFIG = AttrDict({
                                                  'use_prelu': bool(params.use_prelu),
                                                  'use_batch_norm': bool(params.use_batch_norm),
                                                  'batch_norm_first': bool(params.batch_norm_first),
+                                                 'rnn_backend': params.rnn_backend,
+                                                 'rnn_unroll': bool(params.rnn_unroll),
                                                  },
                                 'optimizer_params': {'lr': params.lr,
                                                      'momentum': params.momentum,
@@ -323,6 +343,7 @@ SOLUTION_CONFIG = AttrDict({
                                        'solver': 'sag',
                                        'max_iter': params.max_iter,
                                        'n_jobs': params.num_workers,
+                                       'label_n_jobs': params.num_workers,
                                        },
     'catboost_ensemble': {'label_nr': 6,
                           'iterations': params.catboost__iterations,
@@ -331,5 +352,6 @@ SOLUTION_CONFIG = AttrDict({
                           'l2_leaf_reg': params.catboost__l2_leaf_reg,
                           'border_count': params.catboost__border_count,
                           'verbose': bool(params.catboost__verbose),
+                          'label_n_jobs': params.num_workers,
                           },
 })
@@ -75,12 +75,14 @@ def bad_word_count_features_logreg(config):
     normalizer = _count_features(config)
     xy_split = normalizer.get_step('xy_split')
     tfidf_word_vectorizer = _bad_word_tfidf(preprocessed_input, config)
+    bad_word_count_normalizer = _bad_word_count_features(tfidf_word_vectorizer, config)
 
     bad_word_count_logreg = Step(name='bad_word_count_logreg',
                                  transformer=LogisticRegressionMultilabel(**config.logistic_regression_multilabel),
-                                 input_steps=[xy_split, normalizer, tfidf_word_vectorizer],
+                                 input_steps=[xy_split, normalizer, tfidf_word_vectorizer, bad_word_count_normalizer],
                                  adapter={'X': ([('normalizer', 'X'),
-                                                 ('bad_word_tfidf_word_vectorizer', 'features')], sparse_hstack_inputs),
+                                                 ('bad_word_tfidf_word_vectorizer', 'features'),
+                                                 ('bad_word_count_normalizer', 'X')], sparse_hstack_inputs),
                                           'y': ([('xy_split', 'y')]),
                                           },
                                  cache_dirpath=config.env.cache_dirpath)
@@ -100,6 +102,7 @@ def hand_crafted_all_logreg(config):
     normalizer = _count_features(config)
     xy_split = normalizer.get_step('xy_split')
     bad_word_vectorizer = _bad_word_tfidf(preprocessed_input, config)
+    bad_word_count_normalizer = _bad_word_count_features(bad_word_vectorizer, config)
 
     all_handcrafted_logreg = Step(name='all_handcrafted_logreg',
                                   transformer=LogisticRegressionMultilabel(**config.logistic_regression_multilabel),
@@ -107,11 +110,13 @@ def hand_crafted_all_logreg(config):
                                                normalizer,
                                                tfidf_char_vectorizer,
                                                tfidf_word_vectorizer,
-                                               bad_word_vectorizer],
+                                               bad_word_vectorizer,
+                                               bad_word_count_normalizer],
                                   adapter={'X': ([('normalizer', 'X'),
                                                   ('tfidf_char_vectorizer', 'features'),
                                                   ('tfidf_word_vectorizer', 'features'),
-                                                  ('bad_word_tfidf_word_vectorizer', 'features')],
+                                                  ('bad_word_tfidf_word_vectorizer', 'features'),
+                                                  ('bad_word_count_normalizer', 'X')],
                                                  sparse_hstack_inputs),
                                            'y': ([('xy_split', 'y')]),
                                            },
@@ -801,6 +806,17 @@ def _bad_word_tfidf(preprocessed_input, config):
     return tfidf_word_vectorizer
 
 
+def _bad_word_count_features(bad_word_vectorizer, config):
+    bad_word_filter = bad_word_vectorizer.get_step('bad_word_filter')
+
+    bad_word_count_normalizer = Step(name='bad_word_count_normalizer',
+                                     transformer=Normalizer(),
+                                     input_steps=[bad_word_filter],
+                                     adapter={'X': ([('bad_word_filter', 'counts')])},
+                                     cache_dirpath=config.env.cache_dirpath)
+    return bad_word_count_normalizer
+
+
 def _count_features(config):
     xy_split = Step(name='xy_split',
                     transformer=XYSplit(**config.xy_splitter),
@@ -1,19 +1,23 @@
 import os
 import pprint
+import time
 
 import numpy as np
-from scipy import sparse
 from sklearn.externals import joblib
 
-from steps.utils import view_graph, plot_graph
+from steps.cache import touch
+from steps.executor import Executor
+from steps.utils import view_graph, plot_graph, fingerprint, save_step_output, load_step_output, csr_hstack
 from utils import get_logger
 
 logger = get_logger()
 
+TIMINGS_DIRNAME = 'step_timings'
+
 
 class Step:
     def __init__(self, name, transformer, input_steps=[], input_data=[], adapter=None, cache_dirpath=None,
-                 cache_output=False, overwrite_transformer=False, save_graph=False):
+                 cache_output=False, overwrite_transformer=False, freeze_transformer=False, save_graph=False):
         self.name = name
         self.transformer = transformer
 
@@ -22,8 +26,14 @@ class Step:
         self.adapter = adapter
 
         self.overwrite_transformer = overwrite_transformer
+        self.freeze_transformer = freeze_transformer
         self.cache_output = cache_output
 
+        self.transformer_config_key = fingerprint(transformer)
+        self.transformer_key = self._get_transformer_key()
+        self.fitted_transformer_key = None
+        self.output_key = None
+
         self.cache_dirpath = cache_dirpath
         self._prep_cache(cache_dirpath)
 
@@ -33,14 +43,59 @@ class Step:
             joblib.dump(self.graph_info, graph_filepath)
 
     def _prep_cache(self, cache_dirpath):
-        for dirname in ['transformers', 'outputs']:
+        for dirname in ['transformers', 'transformer_keys', 'outputs']:
             os.makedirs(os.path.join(cache_dirpath, dirname), exist_ok=True)
 
         self.cache_dirpath_transformers = os.path.join(cache_dirpath, 'transformers')
         self.save_dirpath_outputs = os.path.join(cache_dirpath, 'outputs')
+        self.save_dirpath_timings = os.path.join(os.path.dirname(os.path.abspath(cache_dirpath)), TIMINGS_DIRNAME)
+        os.makedirs(self.save_dirpath_timings, exist_ok=True)
+        self.recorded_transformer_key_filepath = os.path.join(cache_dirpath, 'transformer_keys',
+                                                              '{}_{}'.format(self.name, self.transformer_key))
+
+    def _get_transformer_key(self):
+        upstream_config_keys = {step.transformer_config_key for step in self.all_steps.values() if step is not self}
+        return fingerprint([self.transformer_config_key, upstream_config_keys])
+
+    def set_output_key(self, data_fingerprints, is_fit):
+        """
+        Keys the fitted transformer and the output of the step.
+
+        In a fit run the transformer is keyed by its config and the keys of the inputs it is
+        fitted on, so a change of the training data refits it. In a transform run the step uses
+        the transformer recorded by the last fit run of the same config, if there is one.
+        A step with freeze_transformer set uses the recorded transformer in fit runs too, e.g.
+        one fitted out of core with Executor.fit_stream, and is never refitted.
+        """
+        input_step_keys = [input_step.output_key for input_step in self.input_steps]
+        input_data_keys = [data_fingerprints[input_data_part] for input_data_part in self.input_data]
+        recorded_transformer_key = None if is_fit and not self.freeze_transformer else self.recorded_transformer_key
+        if self.freeze_transformer and recorded_transformer_key is None:
+            raise ValueError('step {} is frozen but no fitted transformer was recorded for it'.format(self.name))
+        if recorded_transformer_key is not None:
+            self.fitted_transformer_key = recorded_transformer_key
+        else:
+            self.fitted_transformer_key = fingerprint([self.transformer_key, self.adapter,
+                                                       input_step_keys, input_data_keys])
+        self.output_key = fingerprint([self.fitted_transformer_key, self.adapter, input_step_keys, input_data_keys])
 
-        self.cache_filepath_step_transformer = os.path.join(self.cache_dirpath_transformers, self.name)
-        self.save_filepath_step_output = os.path.join(self.save_dirpath_outputs, '{}'.format(self.name))
+    @property
+    def recorded_transformer_key(self):
+        if os.path.exists(self.recorded_transformer_key_filepath):
+            return joblib.load(self.recorded_transformer_key_filepath)
+        return None
+
+    def _record_transformer_key(self):
+        joblib.dump(self.fitted_transformer_key, self.recorded_transformer_key_filepath)
+
+    @property
+    def cache_filepath_step_transformer(self):
+        fitted_transformer_key = self.fitted_transformer_key or self.recorded_transformer_key
+        return os.path.join(self.cache_dirpath_transformers, '{}_{}'.format(self.name, fitted_transformer_key))
+
+    @property
+    def save_filepath_step_output(self):
+        return os.path.join(self.save_dirpath_outputs, '{}_{}'.format(self.name, self.output_key))
 
     @property
     def named_steps(self):
@@ -55,32 +110,106 @@ class Step:
 
     @property
     def output_is_cached(self):
-        return os.path.exists(self.save_filepath_step_output)
+        return self.output_key is not None and os.path.exists(self.save_filepath_step_output)
 
-    def fit_transform(self, data):
-        if self.output_is_cached and self.cache_output and not self.overwrite_transformer:
-            logger.info('step {} loading output...'.format(self.name))
-            step_output_data = self._load_output()
+    def output_is_reusable(self, is_fit):
+        if is_fit:
+            return self.output_is_cached and self.cache_output and not self.overwrite_transformer
         else:
-            step_inputs = {}
-            if self.input_data is not None:
-                for input_data_part in self.input_data:
-                    step_inputs[input_data_part] = data[input_data_part]
+            return self.output_is_cached and self.cache_output
+
+    def fit_transform(self, data, num_workers=1, cache_size_limit=None):
+        return Executor(num_workers, cache_size_limit).run([self], data, is_fit=True)[self.name]
 
-            for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
+    def transform(self, data, num_workers=1, cache_size_limit=None):
+        return Executor(num_workers, cache_size_limit).run([self], data, is_fit=False)[self.name]
 
-            if self.adapter:
-                step_inputs = self.adapt(step_inputs)
+    def get_action(self, is_fit, load_output, ignore_cache=False):
+        if load_output:
+            return 'load_output'
+        elif self.transformer_is_cached and not ignore_cache and not (is_fit and self.overwrite_transformer):
+            return 'transform'
+        elif is_fit:
+            return 'fit_transform'
+        else:
+            return 'missing_transformer'
+
+    def get_timing(self, action):
+        """
+        Returns the last recorded wall time of the action for this step config, or None.
+
+        Timings are kept next to the cache directory rather than inside it and keyed by the
+        transformer key, so they survive the cache being wiped by overwrite and are shared by
+        the experiments that use the same step config.
+        """
+        timing_filepath = self._get_timing_filepath(action)
+        if os.path.exists(timing_filepath):
+            return joblib.load(timing_filepath)
+        else:
+            return None
+
+    def _save_timing(self, action, elapsed_time):
+        joblib.dump(elapsed_time, self._get_timing_filepath(action))
+
+    def _get_timing_filepath(self, action):
+        return os.path.join(self.save_dirpath_timings, '{}_{}_{}'.format(self.name, self.transformer_key, action))
+
+    def execute(self, data, step_outputs, is_fit, load_output):
+        action = self.get_action(is_fit, load_output)
+        start_time = time.time()
+        if load_output:
+            logger.info('step {} loading output...'.format(self.name))
+            step_output_data = self._load_output()
+        else:
+            step_inputs = self._get_step_inputs(data, step_outputs)
+            if is_fit:
+                step_output_data = self._cached_fit_transform(step_inputs)
             else:
-                step_inputs = self.unpack(step_inputs)
-            step_output_data = self._cached_fit_transform(step_inputs)
+                step_output_data = self._cached_transform(step_inputs)
+        if is_fit and self.transformer_is_cached:
+            self._record_transformer_key()
+        self._save_timing(action, time.time() - start_time)
         return step_output_data
 
+    def save_transformer(self):
+        logger.info('step {} saving transformer...'.format(self.name))
+        self.transformer.save(self.cache_filepath_step_transformer)
+        self._record_transformer_key()
+
+    def load_transformer(self):
+        if self.transformer_is_cached:
+            logger.info('step {} loading transformer...'.format(self.name))
+            self._load_transformer()
+        else:
+            raise ValueError('No transformer cached {}'.format(self.name))
+
+    def transform_chunk(self, data_chunk, step_outputs):
+        step_inputs = self._get_step_inputs(data_chunk, step_outputs)
+        return self.transformer.transform_chunk(**step_inputs)
+
+    def fit_chunk(self, data_chunk, step_outputs):
+        step_inputs = self._get_step_inputs(data_chunk, step_outputs)
+        self.transformer.fit_partial(**step_inputs)
+
+    def _get_step_inputs(self, data, step_outputs):
+        step_inputs = {}
+        if self.input_data is not None:
+            for input_data_part in self.input_data:
+                step_inputs[input_data_part] = data[input_data_part]
+
+        for input_step in self.input_steps:
+            step_inputs[input_step.name] = step_outputs[input_step.name]
+
+        if self.adapter:
+            step_inputs = self.adapt(step_inputs)
+        else:
+            step_inputs = self.unpack(step_inputs)
+        return step_inputs
+
     def _cached_fit_transform(self, step_inputs):
         if self.transformer_is_cached and not self.overwrite_transformer:
             logger.info('step {} loading transformer...'.format(self.name))
-            self.transformer.load(self.cache_filepath_step_transformer)
+            self._load_transformer()
             logger.info('step {} transforming...'.format(self.name))
             step_output_data = self.transformer.transform(**step_inputs)
             if self.cache_output:
@@ -96,36 +225,21 @@ class Step:
                 self._save_output(step_output_data)
         return step_output_data
 
+    def _load_transformer(self):
+        touch(self.cache_filepath_step_transformer)
+        self.transformer.load(self.cache_filepath_step_transformer)
+
     def _load_output(self):
-        return joblib.load(self.save_filepath_step_output)
+        touch(self.save_filepath_step_output)
+        return load_step_output(self.save_filepath_step_output)
 
     def _save_output(self, output_data):
-        joblib.dump(output_data, self.save_filepath_step_output)
-
-    def transform(self, data):
-        if self.output_is_cached and self.cache_output:
-            logger.info('step {} loading output...'.format(self.name))
-            step_output_data = self._load_output()
-        else:
-            step_inputs = {}
-            if self.input_data is not None:
-                for input_data_part in self.input_data:
-                    step_inputs[input_data_part] = data[input_data_part]
-
-            for input_step in self.input_steps:
-                step_inputs[input_step.name] = input_step.fit_transform(data)
-
-            if self.adapter:
-                step_inputs = self.adapt(step_inputs)
-            else:
-                step_inputs = self.unpack(step_inputs)
-            step_output_data = self._cached_transform(step_inputs)
-        return step_output_data
+        save_step_output(output_data, self.save_filepath_step_output)
 
     def _cached_transform(self, step_inputs):
         if self.transformer_is_cached:
             logger.info('step {} loading transformer...'.format(self.name))
-            self.transformer.load(self.cache_filepath_step_transformer)
+            self._load_transformer()
             logger.info('step {} transforming...'.format(self.name))
             step_output_data = self.transformer.transform(**step_inputs)
             if self.cache_output:
@@ -203,12 +317,35 @@ class Step:
 
 
 class BaseTransformer:
+    """
+    Note:
+        Transformers whose transform processes rows independently once fitted set chunkable = True.
+        Such transformers can be run by Executor.stream on fixed-size chunks of rows through
+        transform_chunk. Transformers that can be fitted incrementally implement fit_partial
+        and, if they need to compute something once all the chunks were seen,
+        finish_partial_fit. Executor.fit_stream calls both.
+        Transformers that start their own joblib worker processes set main_thread = True.
+        joblib runs Parallel serially when it is called outside the main thread, so the
+        Executor runs such steps on the main thread, one at a time.
+    """
+    chunkable = False
+    main_thread = False
+
     def fit(self, *args, **kwargs):
         return self
 
+    def fit_partial(self, *args, **kwargs):
+        raise NotImplementedError('{} does not support incremental fitting'.format(self.__class__.__name__))
+
+    def finish_partial_fit(self):
+        return self
+
     def transform(self, *args, **kwargs):
         return NotImplementedError
 
+    def transform_chunk(self, *args, **kwargs):
+        return self.transform(*args, **kwargs)
+
     def fit_transform(self, *args, **kwargs):
         self.fit(*args, **kwargs)
         return self.transform(*args, **kwargs)
@@ -239,6 +376,8 @@ class MockTransformer(BaseTransformer):
 
 
 class Dummy(BaseTransformer):
+    chunkable = True
+
     def transform(self, **kwargs):
         return kwargs
 
@@ -258,7 +397,7 @@ def identity_inputs(inputs):
 
 
 def sparse_hstack_inputs(inputs):
-    return sparse.hstack(inputs)
+    return csr_hstack(inputs)
 
 
 def hstack_inputs(inputs):
@@ -0,0 +1,96 @@
+import os
+import shutil
+
+from sklearn.externals import joblib
+
+from steps.utils import get_logger
+
+logger = get_logger()
+
+CACHED_DIRNAMES = ['transformers', 'outputs']
+TRANSFORMER_KEYS_DIRNAME = 'transformer_keys'
+
+
+class CacheManager:
+    """
+    Keeps the transformers/ and outputs/ directories of a cache_dirpath under size_limit bytes.
+
+    The modification time of an artifact is its last access time: it is set when the artifact
+    is saved and refreshed with touch() whenever it is loaded. When the cache is over budget the
+    least recently used artifacts are removed first. Artifacts listed as protected, i.e. the
+    ones needed by the current run's plan, are never removed. Removing a transformer also
+    removes the transformer_keys/ records pointing to it, so that transform runs do not look
+    for it anymore.
+    """
+
+    def __init__(self, cache_dirpath, size_limit):
+        self.cache_dirpath = cache_dirpath
+        self.size_limit = size_limit
+
+    def get_artifacts(self):
+        artifacts = []
+        for dirname in CACHED_DIRNAMES:
+            dirpath = os.path.join(self.cache_dirpath, dirname)
+            if not os.path.isdir(dirpath):
+                continue
+            for filename in os.listdir(dirpath):
+                if filename.startswith('.tmp_'):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                artifacts.append({'filepath': filepath,
+                                  'last_access': os.path.getmtime(filepath),
+                                  'size': get_size(filepath)})
+        return artifacts
+
+    def collect_garbage(self, protected_filepaths=()):
+        protected_filepaths = {os.path.abspath(filepath) for filepath in protected_filepaths}
+        artifacts = self.get_artifacts()
+        cache_size = sum(artifact['size'] for artifact in artifacts)
+
+        for artifact in sorted(artifacts, key=lambda artifact: artifact['last_access']):
+            if cache_size <= self.size_limit:
+                break
+            if os.path.abspath(artifact['filepath']) in protected_filepaths:
+                continue
+            logger.info('cache over budget, removing {}'.format(artifact['filepath']))
+            remove(artifact['filepath'])
+            cache_size -= artifact['size']
+            if os.path.basename(os.path.dirname(artifact['filepath'])) == 'transformers':
+                self._remove_transformer_records(artifact['filepath'])
+
+        if cache_size > self.size_limit:
+            logger.info('cache size {} bytes still exceeds limit {} bytes with protected artifacts only'.format(
+                cache_size, self.size_limit))
+        return cache_size
+
+    def _remove_transformer_records(self, transformer_filepath):
+        dirpath = os.path.join(self.cache_dirpath, TRANSFORMER_KEYS_DIRNAME)
+        if not os.path.isdir(dirpath):
+            return
+        transformer_filename = os.path.basename(transformer_filepath)
+        for filename in os.listdir(dirpath):
+            filepath = os.path.join(dirpath, filename)
+            step_name = filename.rsplit('_', 1)[0]
+            if '{}_{}'.format(step_name, joblib.load(filepath)) == transformer_filename:
+                logger.info('removing transformer key record {}'.format(filepath))
+                os.remove(filepath)
+
+
+def touch(filepath):
+    if os.path.exists(filepath):
+        os.utime(filepath, None)
+
+
+def get_size(filepath):
+    if os.path.isdir(filepath):
+        return sum(os.path.getsize(os.path.join(dirpath, filename))
+                   for dirpath, _, filenames in os.walk(filepath) for filename in filenames)
+    else:
+        return os.path.getsize(filepath)
+
+
+def remove(filepath):
+    if os.path.isdir(filepath):
+        shutil.rmtree(filepath)
+    else:
+        os.remove(filepath)
@@ -0,0 +1,287 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from steps.cache import CacheManager
+from steps.utils import get_logger, fingerprint
+
+logger = get_logger()
+
+
+class Executor:
+    """
+    Runs a Step graph in topological order.
+
+    Every step reachable from the output steps is executed at most once per run. Steps whose
+    inputs are ready are submitted to a thread pool of num_workers threads, so independent
+    light steps and loading of cached outputs overlap. Transformers with main_thread set,
+    i.e. the ones parallelized with their own n_jobs worker processes, are run one at a time
+    on the calling thread meanwhile: joblib does not start processes from other threads, and
+    their pure python work would not run concurrently on threads because of the GIL.
+    Intermediate outputs are dropped as soon as their last consumer has finished.
+    If cache_size_limit (bytes) is set, cached artifacts not needed by the run are evicted
+    least recently used first every time a step has finished.
+    """
+
+    def __init__(self, num_workers=1, cache_size_limit=None):
+        self.num_workers = num_workers
+        self.cache_size_limit = cache_size_limit
+
+    def run(self, output_steps, data, is_fit):
+        plan = self.get_plan(output_steps, data, is_fit)
+        step_outputs = {}
+        self._consumer_counts = get_consumer_counts(plan)
+        self._output_names = {step.name for step in output_steps}
+        self._protected_filepaths = get_protected_filepaths(plan)
+        if self.num_workers is not None and self.num_workers > 1:
+            self._run_parallel(plan, data, step_outputs)
+        else:
+            self._run_serial(plan, data, step_outputs)
+        return {step.name: step_outputs[step.name] for step in output_steps}
+
+    def get_plan(self, output_steps, data, is_fit, ignore_cache=False):
+        """
+        Returns the list of plan nodes sorted topologically, without executing anything.
+
+        Output steps are run in the requested mode while all the upstream steps are run in
+        fit_transform mode, which mirrors how Step.transform has always treated its inputs.
+        A step whose output can be loaded from cache does not pull in its input steps.
+        With ignore_cache the plan is made as if the cache was empty, e.g. because it is
+        going to be wiped before the run.
+        """
+        set_output_keys(output_steps, lambda input_data_part: fingerprint(data[input_data_part]), is_fit)
+        nodes = {}
+        for output_step in output_steps:
+            self._add_node(output_step, is_fit, nodes, ignore_cache)
+        return topological_sort(nodes)
+
+    def _add_node(self, step, is_fit, nodes, ignore_cache=False):
+        if step.name in nodes:
+            return
+        load_output = not ignore_cache and step.output_is_reusable(is_fit)
+        input_steps = [] if load_output else step.input_steps
+        action = step.get_action(is_fit, load_output, ignore_cache)
+        nodes[step.name] = {'step': step,
+                            'is_fit': is_fit,
+                            'load_output': load_output,
+                            'action': action,
+                            'estimated_time': step.get_timing(action),
+                            'input_names': [input_step.name for input_step in input_steps],
+                            }
+        for input_step in input_steps:
+            self._add_node(input_step, True, nodes, ignore_cache)
+
+    def _run_serial(self, plan, data, step_outputs):
+        for node in plan:
+            step_outputs[node['step'].name] = self._run_node(node, data, step_outputs)
+            self._release_inputs(node, step_outputs)
+            self._collect_garbage()
+
+    def _run_parallel(self, plan, data, step_outputs):
+        pending = [(node, set(node['input_names'])) for node in plan]
+        main_thread_nodes, running = [], {}
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            while pending or main_thread_nodes or running:
+                still_pending = []
+                for node, missing_inputs in pending:
+                    if missing_inputs:
+                        still_pending.append((node, missing_inputs))
+                    elif node['step'].transformer.main_thread and not node['load_output']:
+                        main_thread_nodes.append(node)
+                    else:
+                        future = pool.submit(self._run_node, node, data, step_outputs)
+                        running[future] = node
+                pending = still_pending
+
+                if main_thread_nodes:
+                    node = main_thread_nodes.pop(0)
+                    finished = [(node, self._run_node(node, data, step_outputs))]
+                    done = [future for future in running if future.done()]
+                else:
+                    finished = []
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                finished.extend((running.pop(future), future.result()) for future in done)
+
+                for node, output in finished:
+                    step_name = node['step'].name
+                    step_outputs[step_name] = output
+                    self._release_inputs(node, step_outputs)
+                    for _, missing_inputs in pending:
+                        missing_inputs.discard(step_name)
+                if finished:
+                    self._collect_garbage()
+
+    def stream(self, output_steps, data_chunks):
+        """
+        Transforms an iterable of data chunks, e.g. built from pandas.read_csv(chunksize=...),
+        with already fitted transformers and yields the output step outputs for every chunk.
+        """
+        plan = self.get_chunk_plan(output_steps)
+        for data_chunk in data_chunks:
+            yield self.transform_chunk(plan, output_steps, data_chunk)
+
+    def fit_stream(self, output_steps, get_data_chunks):
+        """
+        Fits the output steps and their input steps out of core with fit_partial.
+
+        get_data_chunks is called once per step to fit, plus once to fingerprint the data, and
+        returns a fresh iterable of data chunks. Steps are fitted one at a time in topological
+        order: every chunk is passed through the already fitted input steps and given to
+        fit_partial, then finish_partial_fit is called and the transformer is saved. Steps with
+        a transformer cached for the same data are loaded instead, unless overwrite_transformer
+        is set.
+        """
+        plan = self.get_chunk_plan(output_steps, load_transformers=False)
+        data_fingerprint = fingerprint([fingerprint(data_chunk) for data_chunk in get_data_chunks()])
+        set_output_keys(output_steps, lambda input_data_part: data_fingerprint, is_fit=True)
+        for i, node in enumerate(plan):
+            step = node['step']
+            if step.transformer_is_cached and not step.overwrite_transformer:
+                step.load_transformer()
+                continue
+            logger.info('step {} fitting on chunks...'.format(step.name))
+            input_plan = [input_node for input_node in plan[:i] if input_node['step'].name in step.all_steps]
+            for data_chunk in get_data_chunks():
+                step.fit_chunk(data_chunk, self._transform_chunk(input_plan, data_chunk))
+            step.transformer.finish_partial_fit()
+            step.save_transformer()
+
+    def get_chunk_plan(self, output_steps, load_transformers=True):
+        steps = {}
+        for output_step in output_steps:
+            steps.update(output_step.all_steps)
+
+        not_chunkable = [step_name for step_name, step in steps.items() if not step.transformer.chunkable]
+        if not_chunkable:
+            raise ValueError('steps {} do not support chunked transform'.format(not_chunkable))
+
+        nodes = {step_name: {'step': step,
+                             'input_names': [input_step.name for input_step in step.input_steps]}
+                 for step_name, step in steps.items()}
+        plan = topological_sort(nodes)
+        for node in plan:
+            node['step'].fitted_transformer_key = None
+        if load_transformers:
+            for node in plan:
+                node['step'].load_transformer()
+        return plan
+
+    def transform_chunk(self, plan, output_steps, data_chunk):
+        step_outputs = self._transform_chunk(plan, data_chunk)
+        return {step.name: step_outputs[step.name] for step in output_steps}
+
+    def _transform_chunk(self, plan, data_chunk):
+        step_outputs = {}
+        for node in plan:
+            step_outputs[node['step'].name] = node['step'].transform_chunk(data_chunk, step_outputs)
+        return step_outputs
+
+    def _collect_garbage(self):
+        if not self.cache_size_limit:
+            return
+        for cache_dirpath, filepaths in self._protected_filepaths.items():
+            CacheManager(cache_dirpath, self.cache_size_limit).collect_garbage(filepaths)
+
+    def _release_inputs(self, node, step_outputs):
+        for input_name in node['input_names']:
+            self._consumer_counts[input_name] -= 1
+            if self._consumer_counts[input_name] == 0 and input_name not in self._output_names:
+                logger.info('step {} output released'.format(input_name))
+                del step_outputs[input_name]
+
+    def _run_node(self, node, data, step_outputs):
+        return node['step'].execute(data, step_outputs, is_fit=node['is_fit'], load_output=node['load_output'])
+
+
+def get_protected_filepaths(plan):
+    protected_filepaths = {}
+    for node in plan:
+        step = node['step']
+        protected_filepaths.setdefault(step.cache_dirpath, set()).update(
+            [step.cache_filepath_step_transformer, step.save_filepath_step_output])
+    return protected_filepaths
+
+
+def topological_sort(nodes):
+    sorted_nodes, visited = [], set()
+
+    def visit(step_name):
+        if step_name in visited:
+            return
+        visited.add(step_name)
+        for input_name in nodes[step_name]['input_names']:
+            visit(input_name)
+        sorted_nodes.append(nodes[step_name])
+
+    for step_name in nodes:
+        visit(step_name)
+    return sorted_nodes
+
+
+def merge_steps(output_steps):
+    """
+    Merges several Step graphs on identically defined steps.
+
+    Steps are matched by name and must agree on the transformer key, adapter and inputs,
+    otherwise a ValueError is raised. Every shared step is replaced by a single instance, so
+    running the merged output steps with one Executor fits and transforms the common prefix once.
+    """
+    canonical_steps = {}
+
+    def visit(step):
+        signature = fingerprint([step.transformer_key, step.adapter, step.input_data,
+                                 [input_step.name for input_step in step.input_steps]])
+        if step.name in canonical_steps:
+            canonical_step, canonical_signature = canonical_steps[step.name]
+            if signature != canonical_signature:
+                raise ValueError('step {} is defined differently in the merged pipelines'.format(step.name))
+            return canonical_step
+        step.input_steps = [visit(input_step) for input_step in step.input_steps]
+        canonical_steps[step.name] = (step, signature)
+        return step
+
+    return [visit(output_step) for output_step in output_steps]
+
+
+def format_plan(plan):
+    lines = ['{:<40} {:<20} {:>12}'.format('step', 'action', 'estimate [s]')]
+    total_time, unknown_nr = 0.0, 0
+    for node in plan:
+        if node['estimated_time'] is None:
+            estimate = 'unknown'
+            unknown_nr += 1
+        else:
+            estimate = '{:.1f}'.format(node['estimated_time'])
+            total_time += node['estimated_time']
+        lines.append('{:<40} {:<20} {:>12}'.format(node['step'].name, node['action'], estimate))
+    lines.append('total estimated time {:.1f}s, {} steps without previous timings'.format(total_time, unknown_nr))
+    return '\n'.join(lines)
+
+
+def get_consumer_counts(plan):
+    consumer_counts = {node['step'].name: 0 for node in plan}
+    for node in plan:
+        for input_name in node['input_names']:
+            consumer_counts[input_name] += 1
+    return consumer_counts
+
+
+def set_output_keys(output_steps, get_data_fingerprint, is_fit):
+    """
+    Content-addresses fitted transformers and step outputs by the transformer key, the adapter,
+    the output keys of the input steps and the fingerprints of the raw input data parts, which
+    get_data_fingerprint returns for an input data part name.
+    """
+    data_fingerprints, visited = {}, set()
+
+    def visit(step):
+        if step.name in visited:
+            return
+        visited.add(step.name)
+        for input_step in step.input_steps:
+            visit(input_step)
+        for input_data_part in step.input_data:
+            if input_data_part not in data_fingerprints:
+                data_fingerprints[input_data_part] = get_data_fingerprint(input_data_part)
+        step.set_output_key(data_fingerprints, is_fit)
+
+    for output_step in output_steps:
+        visit(output_step)
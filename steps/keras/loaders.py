@@ -1,18 +1,42 @@
-from keras.preprocessing import text, sequence
+import re
+from collections import Counter
+from itertools import chain, repeat
+from operator import itemgetter
+
+import numpy as np
 from sklearn.externals import joblib
+from sklearn.externals.joblib import Parallel, delayed
 
 from steps.base import BaseTransformer
+from steps.preprocessing import MIN_ROWS_PER_JOB
+from steps.utils import get_effective_n_jobs, split_into_batches, to_object_array
+
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+FILTER_TRANSLATION = str.maketrans(KERAS_FILTERS, ' ' * len(KERAS_FILTERS))
+FILTER_PATTERN = re.compile('[{}]'.format(re.escape(KERAS_FILTERS)))
+ASCII_FILTER_TRANSLATION = bytes.maketrans(KERAS_FILTERS.encode(), b' ' * len(KERAS_FILTERS))
+ROW_SEPARATOR = '\x00'
+BUCKET_BATCH_NR = 100
 
 
 class Tokenizer(BaseTransformer):
-    def __init__(self, char_level, maxlen, num_words):
+    chunkable = True
+    main_thread = True
+
+    def __init__(self, char_level, maxlen, num_words, n_jobs=1):
         self.char_level = char_level
         self.maxlen = maxlen
         self.num_words = num_words
+        self.n_jobs = n_jobs
 
-        self.tokenizer = text.Tokenizer(char_level=self.char_level, num_words=self.num_words)
+        self.tokenizer = ArrayTokenizer(char_level=self.char_level, num_words=self.num_words, n_jobs=self.n_jobs)
 
     def fit(self, X, X_valid=None, train_mode=True):
+        self.tokenizer = ArrayTokenizer(char_level=self.char_level, num_words=self.num_words, n_jobs=self.n_jobs)
+        self.tokenizer.fit_on_texts(X)
+        return self
+
+    def fit_partial(self, X, X_valid=None, train_mode=True):
         self.tokenizer.fit_on_texts(X)
         return self
 
@@ -28,9 +52,7 @@ class Tokenizer(BaseTransformer):
                 'tokenizer': self.tokenizer}
 
     def _transform(self, X):
-        list_tokenized = self.tokenizer.texts_to_sequences(list(X))
-        X_tokenized = sequence.pad_sequences(list_tokenized, maxlen=self.maxlen)
-        return X_tokenized
+        return self.tokenizer.texts_to_padded_sequences(X, maxlen=self.maxlen)
 
     def load(self, filepath):
         object_pickle = joblib.load(filepath)
@@ -38,6 +60,7 @@ class Tokenizer(BaseTransformer):
         self.maxlen = object_pickle['maxlen']
         self.num_words = object_pickle['num_words']
         self.tokenizer = object_pickle['tokenizer']
+        self.tokenizer.n_jobs = self.n_jobs
         return self
 
     def save(self, filepath):
@@ -48,8 +71,210 @@ class Tokenizer(BaseTransformer):
         joblib.dump(object_pickle, filepath)
 
 
+class ArrayTokenizer:
+    """
+    Drop-in replacement for keras.preprocessing.text.Tokenizer with the keras 2.1.3 defaults:
+    words are lower cased, KERAS_FILTERS characters are treated as separators and word_index
+    ranks the words by count, ties in order of first occurrence, starting at 1.
+
+    The vocabulary is kept as an array of words ordered by index and word_index is built from
+    it on demand. texts_to_padded_sequences encodes whole batches of texts with numpy straight
+    into a preallocated int32 matrix, padded and truncated at the front like
+    keras.preprocessing.sequence.pad_sequences. With n_jobs > 1 large inputs are counted and
+    encoded in joblib workers.
+    """
+
+    def __init__(self, char_level=False, num_words=None, n_jobs=1):
+        self.char_level = char_level
+        self.num_words = num_words
+        self.n_jobs = n_jobs
+        self.word_counts = Counter()
+        self.words = to_object_array([])
+        self._word_index = None
+
+    @property
+    def word_index(self):
+        if self._word_index is None:
+            self._word_index = dict(zip(self.words, range(1, len(self.words) + 1)))
+        return self._word_index
+
+    def fit_on_texts(self, texts):
+        texts = [str(x) for x in np.asarray(texts).ravel()]
+        n_jobs = get_effective_n_jobs(self.n_jobs, len(texts), MIN_ROWS_PER_JOB)
+        if n_jobs > 1:
+            batch_counts = Parallel(n_jobs=n_jobs)(delayed(_count_tokens)(batch, self.char_level)
+                                                   for batch in split_into_batches(texts, n_jobs))
+        else:
+            batch_counts = [_count_tokens(texts, self.char_level)]
+        for counts in batch_counts:
+            self.word_counts.update(counts)
+        self.words = to_object_array([word for word, _ in sorted(self.word_counts.items(),
+                                                                 key=itemgetter(1), reverse=True)])
+        self._word_index = None
+        return self
+
+    def texts_to_sequences(self, texts):
+        lookup = self._get_lookup()
+        return [[lookup[token] for token in _tokenize(x, self.char_level) if token in lookup] for x in texts]
+
+    def texts_to_padded_sequences(self, texts, maxlen=None):
+        texts = [str(x) for x in np.asarray(texts).ravel()]
+        lookup = self._get_lookup()
+        n_jobs = get_effective_n_jobs(self.n_jobs, len(texts), MIN_ROWS_PER_JOB)
+        if maxlen is not None and n_jobs > 1:
+            batches = Parallel(n_jobs=n_jobs)(delayed(_encode_batch)(batch, lookup, self.char_level, maxlen)
+                                              for batch in split_into_batches(texts, n_jobs))
+            return np.vstack(batches)
+        else:
+            return _encode_batch(texts, lookup, self.char_level, maxlen)
+
+    def _get_lookup(self):
+        if self.num_words:
+            return dict(zip(self.words[:self.num_words - 1], range(1, self.num_words)))
+        return self.word_index
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_word_index'] = None
+        return state
+
+
 class TextAugmenter(BaseTransformer):
     pass
     """
     Augmentations by Thesaurus synonim substitution or typos
     """
+
+
+class BucketedBatchGenerator:
+    """
+    Note:
+        Yields batches of the pre-padded sequences X trimmed to the longest sequence of the
+        batch, so that recurrent models do not process maxlen timesteps for short comments.
+        With shuffle=True the rows are shuffled every epoch, cut into buckets of
+        batch_size * BUCKET_BATCH_NR rows sorted by length and the batches of all the buckets
+        are shuffled again. Otherwise the rows are sorted by length once, batches follow that
+        order and restore_order puts the predictions back into the order of X.
+        The generator loops forever, like keras generators, len() is the number of batches.
+    """
+
+    def __init__(self, X, y=None, batch_size=32, shuffle=False, trim=True, random_state=None):
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.trim = trim
+        self.random_state = np.random.RandomState(random_state)
+
+        is_token = X != 0
+        self.lengths = np.where(is_token.any(axis=1), X.shape[1] - is_token.argmax(axis=1), 0)
+        self.order = np.argsort(self.lengths, kind='mergesort')
+        self._batches = self._iter_batches()
+
+    def __len__(self):
+        return int(np.ceil(len(self.X) / self.batch_size))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._batches)
+
+    def restore_order(self, predictions):
+        restored = np.empty_like(predictions)
+        restored[self.order] = predictions
+        return restored
+
+    def _iter_batches(self):
+        while True:
+            for batch_index in self._get_batch_indices():
+                X_batch = self.X[batch_index]
+                if self.trim:
+                    X_batch = X_batch[:, X_batch.shape[1] - max(self.lengths[batch_index].max(), 1):]
+                if self.y is None:
+                    yield X_batch
+                else:
+                    yield X_batch, self.y[batch_index]
+
+    def _get_batch_indices(self):
+        if not self.shuffle:
+            return _split_by_size(self.order, self.batch_size)
+        index = self.random_state.permutation(len(self.X))
+        batch_indices = []
+        for bucket in _split_by_size(index, self.batch_size * BUCKET_BATCH_NR):
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='mergesort')]
+            batch_indices.extend(_split_by_size(bucket, self.batch_size))
+        self.random_state.shuffle(batch_indices)
+        return batch_indices
+
+
+def _tokenize(x, char_level):
+    if char_level:
+        return x
+    return [token for token in x.lower().translate(FILTER_TRANSLATION).split(' ') if token]
+
+
+def _tokenize_batch(texts, char_level):
+    """
+    Tokenizes all the texts with a single lower/filter/split pass over the texts joined by
+    ROW_SEPARATOR tokens. Returns the flat token list, or None if a text contains
+    ROW_SEPARATOR itself.
+    """
+    if char_level:
+        return ''.join(texts)
+    separator = ' {} '.format(ROW_SEPARATOR)
+    tokens = _replace_filters(separator.join(texts).lower()).split(' ')
+    if tokens.count(ROW_SEPARATOR) != len(texts) - 1:
+        return None
+    return tokens
+
+
+def _replace_filters(x):
+    try:
+        return x.encode('ascii').translate(ASCII_FILTER_TRANSLATION).decode('ascii')
+    except UnicodeEncodeError:
+        return FILTER_PATTERN.sub(' ', x)
+
+
+def _count_tokens(texts, char_level):
+    tokens = _tokenize_batch(texts, char_level) if texts else []
+    if tokens is None:
+        return Counter(chain.from_iterable(_tokenize(x, char_level) for x in texts))
+    counts = Counter(tokens)
+    if not char_level:
+        counts.pop('', None)
+        counts.pop(ROW_SEPARATOR, None)
+    return counts
+
+
+def _encode_batch(texts, lookup, char_level, maxlen):
+    tokens = _tokenize_batch(texts, char_level) if texts else []
+    if char_level:
+        ids = np.fromiter(map(lookup.get, tokens, repeat(0)), dtype=np.int32, count=len(tokens))
+        row_ids = np.repeat(np.arange(len(texts)), [len(x) for x in texts])
+    elif tokens is not None:
+        lookup = {**lookup, ROW_SEPARATOR: -1}
+        ids = np.fromiter(map(lookup.get, tokens, repeat(0)), dtype=np.int32, count=len(tokens))
+        row_ids = np.cumsum(ids == -1)
+    else:
+        tokenized_texts = [_tokenize(x, char_level) for x in texts]
+        ids = np.fromiter(map(lookup.get, chain.from_iterable(tokenized_texts), repeat(0)), dtype=np.int32,
+                          count=sum(len(tokens) for tokens in tokenized_texts))
+        row_ids = np.repeat(np.arange(len(texts)), [len(tokens) for tokens in tokenized_texts])
+    is_known = ids > 0
+    ids, row_ids = ids[is_known], row_ids[is_known]
+
+    row_lengths = np.bincount(row_ids, minlength=len(texts))
+    if maxlen is None:
+        maxlen = row_lengths.max() if len(texts) else 0
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    columns = maxlen - row_lengths[row_ids] + np.arange(len(ids)) - row_starts[row_ids]
+    is_kept = columns >= 0
+
+    X = np.zeros((len(texts), maxlen), dtype=np.int32)
+    X[row_ids[is_kept], columns[is_kept]] = ids[is_kept]
+    return X
+
+
+def _split_by_size(index, size):
+    return [index[i:i + size] for i in range(0, len(index), size)]
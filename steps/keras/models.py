@@ -1,25 +1,54 @@
+import os
 import shutil
 
 import numpy as np
 from keras.models import load_model
 from sklearn.externals import joblib
-from gensim.models import KeyedVectors
 
 from steps.base import BaseTransformer
 from .contrib import AttentionWeightedAverage
+from .loaders import BucketedBatchGenerator
+from .utils import EmbeddingStore, convert_embeddings, get_store_dirpath, load_converted_weights
+
+RUNTIME_MODEL_PARAMS = ['rnn_backend', 'rnn_unroll']
+FITTED_MODEL_PARAMS = ['embedding_matrix']
+WORD2VEC_READ_SIZE = 2 ** 24
 
 
 class BasicClassifier(BaseTransformer):
     """
+    Note:
+        Models with rnn_backend='cpu' in their model_params are rebuilt on load and get the
+        saved weights through load_converted_weights, so checkpoints of CuDNN models can be
+        used for inference on machines without a GPU. RUNTIME_MODEL_PARAMS are left out of
+        get_params, which the step fingerprint is computed from, so both backends share the
+        cached transformer. So are FITTED_MODEL_PARAMS, which are set from the step inputs in
+        fit. The configs are copied on init so that fit never changes the config the
+        transformer was built from, e.g. SOLUTION_CONFIG.
+        Models are trained and run on the main thread, one at a time, even when several of
+        them are ready in a merged graph, so they never compete for the GPU memory and the
+        tensorflow session.
+        Predictions are made row by row, so fitted models can be run on chunks of rows.
+
     Todo:
         load the best model at the end of the fit and save it
     """
 
+    chunkable = True
+    main_thread = True
+
     def __init__(self, architecture_config, training_config, callbacks_config):
-        self.architecture_config = architecture_config
+        self.architecture_config = {**architecture_config, 'model_params': dict(architecture_config['model_params'])}
         self.training_config = training_config
         self.callbacks_config = callbacks_config
 
+    def get_params(self):
+        model_params = {key: value for key, value in self.architecture_config['model_params'].items()
+                        if key not in RUNTIME_MODEL_PARAMS + FITTED_MODEL_PARAMS}
+        return {'architecture_config': {**self.architecture_config, 'model_params': model_params},
+                'training_config': self.training_config,
+                'callbacks_config': self.callbacks_config}
+
     def reset(self):
         self.model = self._build_model(**self.architecture_config)
 
@@ -51,8 +80,12 @@ class BasicClassifier(BaseTransformer):
             self.model.save(filepath)
 
     def load(self, filepath):
-        self.model = load_model(filepath,
-                                custom_objects={'AttentionWeightedAverage': AttentionWeightedAverage})
+        if self.architecture_config['model_params'].get('rnn_backend') == 'cpu':
+            self.model = self._build_model(**self.architecture_config['model_params'])
+            load_converted_weights(self.model, filepath)
+        else:
+            self.model = load_model(filepath,
+                                    custom_objects={'AttentionWeightedAverage': AttentionWeightedAverage})
         return self
 
 
@@ -77,7 +110,16 @@ class ClassifierGenerator(BasicClassifier):
     def fit(self, datagen, validation_datagen):
         self.callbacks = self._create_callbacks(**self.callbacks_config)
         self.model = self._compile_model(**self.architecture_config)
+        return self._fit_generator(datagen, validation_datagen)
+
+    def transform(self, datagen, validation_datagen=None):
+        test_flow, test_steps = datagen
+        predictions = self.model.predict_generator(test_flow, test_steps, verbose=1)
+        if isinstance(test_flow, BucketedBatchGenerator):
+            predictions = test_flow.restore_order(predictions)
+        return {'prediction_probability': predictions}
 
+    def _fit_generator(self, datagen, validation_datagen):
         train_flow, train_steps = datagen
         valid_flow, valid_steps = validation_datagen
         self.model.fit_generator(train_flow,
@@ -86,20 +128,61 @@ class ClassifierGenerator(BasicClassifier):
                                  validation_steps=valid_steps,
                                  callbacks=self.callbacks,
                                  verbose=1,
-                                 **self.training_config)
+                                 **self._get_generator_training_config())
         return self
 
-    def transform(self, datagen, validation_datagen=None):
-        test_flow, test_steps = datagen
-        predictions = self.model.predict_generator(test_flow, test_steps, verbose=1)
-        return {'prediction_probability': predictions}
+    def _get_generator_training_config(self):
+        return self.training_config
+
+
+class ClassifierBucketedXY(ClassifierGenerator):
+    """
+    Note:
+        Takes the same pre-padded X as ClassifierXY and feeds it through BucketedBatchGenerator,
+        so that every batch is only as long as its longest sequence. Models built with a fixed
+        input length, e.g. unrolled recurrent layers or models saved before, get full maxlen
+        batches instead.
+    """
+
+    def fit(self, X, y, validation_data):
+        X_valid, y_valid = validation_data
+        self.callbacks = self._create_callbacks(**self.callbacks_config)
+        self.model = self._compile_model(**self.architecture_config)
+        train_flow = self._get_flow(X, y, shuffle=True)
+        valid_flow = self._get_flow(X_valid, y_valid)
+        return self._fit_generator((train_flow, len(train_flow)), (valid_flow, len(valid_flow)))
+
+    def transform(self, X, y=None, validation_data=None):
+        test_flow = self._get_flow(X)
+        return super().transform((test_flow, len(test_flow)))
+
+    def _get_flow(self, X, y=None, shuffle=False):
+        return BucketedBatchGenerator(X, y, batch_size=self.training_config['batch_size'], shuffle=shuffle,
+                                      trim=self.model.input_shape[1] is None)
+
+    def _get_generator_training_config(self):
+        return {key: value for key, value in self.training_config.items() if key != 'batch_size'}
 
 
 class EmbeddingsMatrix(BaseTransformer):
-    def __init__(self, pretrained_filepath, max_features, embedding_size):
+    """
+    Note:
+        If store_dir holds an EmbeddingStore converted from pretrained_filepath with
+        convert_store, the vectors of the words from tokenizer.word_index that fit in
+        max_features are looked up in it at once. Otherwise _get_embedding_matrix streams the
+        pretrained file through _iter_vectors and parses only the vectors of those words,
+        written in place into a float32 matrix. Either way the rows of words without a
+        pretrained vector are drawn from a normal distribution with the mean and std of the
+        vectors found rather than of the whole file, so both paths give the same matrix.
+        transform returns the fitted matrix whatever the input, so it can be run on chunks.
+    """
+    chunkable = True
+
+    def __init__(self, pretrained_filepath, max_features, embedding_size, store_dir=None):
         self.pretrained_filepath = pretrained_filepath
         self.max_features = max_features
         self.embedding_size = embedding_size
+        self.store_dir = store_dir
 
     def fit(self, tokenizer):
         self.embedding_matrix = self._get_embedding_matrix(tokenizer)
@@ -108,9 +191,68 @@ class EmbeddingsMatrix(BaseTransformer):
     def transform(self, tokenizer):
         return {'embeddings_matrix': self.embedding_matrix}
 
+    @property
+    def store_dirpath(self):
+        if self.store_dir is None:
+            return None
+        return get_store_dirpath(self.store_dir, self.pretrained_filepath)
+
+    def convert_store(self):
+        if self.store_dirpath is None:
+            raise ValueError('store_dir is not set')
+        word_vectors = ((word, self._parse_vector(values)) for word, values in self._iter_vectors())
+        convert_embeddings(word_vectors, self.store_dirpath)
+
     def _get_embedding_matrix(self, tokenizer):
+        word_index = tokenizer.word_index
+        nb_words = min(self.max_features, len(word_index))
+        requested_words = {word: i for word, i in word_index.items() if i < nb_words}
+        if self.store_dirpath is not None and os.path.isdir(self.store_dirpath):
+            return self._get_stored_embedding_matrix(requested_words, nb_words)
+        return self._get_streamed_embedding_matrix(requested_words, nb_words)
+
+    def _get_stored_embedding_matrix(self, requested_words, nb_words):
+        store = EmbeddingStore(self.store_dirpath)
+        if store.embedding_size != self.embedding_size:
+            raise ValueError('embedding store {} has vectors of size {}, expected {}'.format(
+                self.store_dirpath, store.embedding_size, self.embedding_size))
+        words, indices = list(requested_words.keys()), np.array(list(requested_words.values()), dtype=np.int64)
+        positions, vectors = store.get_vectors(words)
+
+        embedding_matrix = np.empty((nb_words, self.embedding_size), dtype=np.float32)
+        is_found = np.zeros(nb_words, dtype=bool)
+        embedding_matrix[indices[positions]] = vectors
+        is_found[indices[positions]] = True
+        return self._fill_missing_rows(embedding_matrix, is_found)
+
+    def _get_streamed_embedding_matrix(self, requested_words, nb_words):
+        embedding_matrix = np.empty((nb_words, self.embedding_size), dtype=np.float32)
+        is_found = np.zeros(nb_words, dtype=bool)
+        for word, values in self._iter_vectors():
+            i = requested_words.get(word)
+            if i is None:
+                continue
+            embedding_vector = self._parse_vector(values)
+            if embedding_vector.shape[0] != self.embedding_size:
+                continue
+            embedding_matrix[i] = embedding_vector
+            is_found[i] = True
+        return self._fill_missing_rows(embedding_matrix, is_found)
+
+    def _fill_missing_rows(self, embedding_matrix, is_found):
+        if not is_found.any():
+            raise ValueError('none of the words has a pretrained vector in {}'.format(self.pretrained_filepath))
+        found_vectors = embedding_matrix[is_found]
+        emb_mean, emb_std = found_vectors.mean(dtype=np.float64), found_vectors.std(dtype=np.float64)
+        embedding_matrix[~is_found] = np.random.normal(emb_mean, emb_std, ((~is_found).sum(), self.embedding_size))
+        return embedding_matrix
+
+    def _iter_vectors(self):
         return NotImplementedError
 
+    def _parse_vector(self, values):
+        return np.asarray(values.split(' '), dtype=np.float32)
+
     def save(self, filepath):
         joblib.dump(self.embedding_matrix, filepath)
 
@@ -120,76 +262,48 @@ class EmbeddingsMatrix(BaseTransformer):
 
 
 class GloveEmbeddingsMatrix(EmbeddingsMatrix):
-    def _get_embedding_matrix(self, tokenizer):
-        embeddings_index = dict()
+    def _iter_vectors(self):
         with open(self.pretrained_filepath) as f:
             for line in f:
-                # Note: use split(' ') instead of split() if you get an error.
-                values = line.split(' ')
-                word = values[0]
-                coefs = np.asarray(values[1:], dtype='float32')
-                embeddings_index[word] = coefs
-
-        all_embs = np.stack(embeddings_index.values())
-        emb_mean, emb_std = all_embs.mean(), all_embs.std()
-
-        word_index = tokenizer.word_index
-        nb_words = min(self.max_features, len(word_index))
-        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size))
-        for word, i in word_index.items():
-            if i >= self.max_features:
-                continue
-            embedding_vector = embeddings_index.get(word)
-            if embedding_vector is not None:
-                embedding_matrix[i] = embedding_vector
-        return embedding_matrix
+                word, values = line.rstrip('\n').split(' ', 1)
+                yield word, values
 
 
 class Word2VecEmbeddingsMatrix(EmbeddingsMatrix):
-    def _get_embedding_matrix(self, tokenizer):
-        model = KeyedVectors.load_word2vec_format(self.pretrained_filepath, binary=True)
-
-        emb_mean, emb_std = model.syn0.mean(), model.syn0.std()
+    """
+    Note:
+        The binary word2vec file is read directly in blocks of WORD2VEC_READ_SIZE bytes instead
+        of being loaded as a whole gensim model. _iter_vectors yields the raw bytes of every
+        vector and only the ones that are needed are decoded into float32 by _parse_vector.
+    """
 
-        word_index = tokenizer.word_index
-        nb_words = min(self.max_features, len(word_index))
-        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size))
-        for word, i in word_index.items():
-            if i >= self.max_features:
-                continue
-            try:
-                embedding_vector = model[word]
-                embedding_matrix[i] = embedding_vector
-            except KeyError:
-                continue
-        return embedding_matrix
+    def _iter_vectors(self):
+        with open(self.pretrained_filepath, 'rb') as f:
+            word_nr, vector_size = map(int, f.readline().split())
+            vector_bytes = vector_size * np.dtype(np.float32).itemsize
+            buffer, position = f.read(WORD2VEC_READ_SIZE), 0
+            for _ in range(word_nr):
+                space = buffer.find(b' ', position)
+                if space == -1 or space + 1 + vector_bytes > len(buffer):
+                    buffer, position = buffer[position:] + f.read(WORD2VEC_READ_SIZE), 0
+                    space = buffer.find(b' ', position)
+                    if space == -1 or space + 1 + vector_bytes > len(buffer):
+                        raise ValueError('unexpected end of file in {}'.format(self.pretrained_filepath))
+                word = buffer[position:space].lstrip(b'\n').decode('utf-8')
+                position = space + 1 + vector_bytes
+                yield word, buffer[space + 1:position]
+
+    def _parse_vector(self, values):
+        return np.frombuffer(values, dtype='<f4').astype(np.float32)
 
 
 class FastTextEmbeddingsMatrix(EmbeddingsMatrix):
-    def _get_embedding_matrix(self, tokenizer):
-        embeddings_index = dict()
+    def _iter_vectors(self):
         with open(self.pretrained_filepath) as f:
             for i, line in enumerate(f):
                 line = line.strip()
                 if i == 0:
                     continue
-                values = line.split(' ')
-                word = values[0]
-                coefs = np.asarray(values[1:], dtype='float32')
-                if coefs.shape[0] != self.embedding_size:
-                    continue
-                embeddings_index[word] = coefs
+                word, values = line.split(' ', 1)
+                yield word, values
 
-        all_embs = np.stack(embeddings_index.values())
-        emb_mean, emb_std = all_embs.mean(), all_embs.std()
-
-        word_index = tokenizer.word_index
-        nb_words = min(self.max_features, len(word_index))
-        embedding_matrix = np.random.normal(emb_mean, emb_std, (nb_words, self.embedding_size))
-        for word, i in word_index.items():
-            if i >= self.max_features:
-                continue
-            embedding_vector = embeddings_index.get(word)
-            if embedding_vector is not None:
-                embedding_matrix[i] = embedding_vector
-        return embedding_matrix
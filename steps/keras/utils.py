@@ -0,0 +1,177 @@
+import os
+import shutil
+import tempfile
+
+import h5py
+import numpy as np
+from sklearn.externals import joblib
+
+from steps.utils import get_logger, fingerprint
+
+logger = get_logger()
+
+MAX_WORD_BYTES = 64
+CONVERSION_BATCH_SIZE = 100000
+
+
+class EmbeddingStore:
+    """
+    Pretrained word vectors converted once with convert_embeddings.
+
+    The store directory holds vectors.npy, a float32 matrix memory-mapped on load, words.npy,
+    the utf-8 encoded words sorted bytewise with the rows of vectors.npy in the same order,
+    and stats.pkl with the embedding size.
+    get_vectors looks a batch of words up with a single searchsorted on the sorted words, so
+    only the pages of the requested rows are read from disk.
+    """
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.words = np.load(os.path.join(dirpath, 'words.npy'), mmap_mode='r')
+        self.vectors = np.load(os.path.join(dirpath, 'vectors.npy'), mmap_mode='r')
+        stats = joblib.load(os.path.join(dirpath, 'stats.pkl'))
+        self.embedding_size = stats['embedding_size']
+
+    def get_vectors(self, words):
+        """
+        Returns the positions in words that have a vector and the float32 vectors themselves.
+        """
+        encoded_words = [word.encode('utf-8') for word in words]
+        is_storable = np.array([len(word) <= self.words.dtype.itemsize for word in encoded_words], dtype=bool)
+        positions = np.where(is_storable)[0]
+        queries = np.array([encoded_words[i] for i in positions], dtype=self.words.dtype)
+
+        rows = np.searchsorted(self.words, queries)
+        rows[rows == len(self.words)] = 0
+        is_found = self.words[rows] == queries
+        positions, rows = positions[is_found], rows[is_found]
+
+        order = np.argsort(rows)
+        return positions[order], np.asarray(self.vectors[rows[order]], dtype=np.float32)
+
+
+def get_store_dirpath(store_dir, pretrained_filepath):
+    """
+    Stores are named after the file and a fingerprint of its absolute path, so files with the
+    same name in different directories get separate stores.
+    """
+    pretrained_filepath = os.path.abspath(os.path.expanduser(pretrained_filepath))
+    return os.path.join(store_dir, '{}_{}.store'.format(os.path.basename(pretrained_filepath),
+                                                        fingerprint(pretrained_filepath)[:16]))
+
+
+def convert_embeddings(word_vectors, store_dirpath):
+    """
+    Writes an EmbeddingStore from an iterable of (word, float32 vector) pairs.
+
+    Vectors are appended to a raw file while they are read, so the whole file is never held in
+    memory, and copied in sorted word order in batches of CONVERSION_BATCH_SIZE rows at the
+    end. When a word occurs more than once its last vector is kept. Words longer than
+    MAX_WORD_BYTES bytes and vectors of a different size than the first one are skipped.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(store_dirpath)), exist_ok=True)
+    tmp_dirpath = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(store_dirpath)), prefix='.tmp_')
+    raw_filepath = os.path.join(tmp_dirpath, 'vectors.raw')
+
+    words, embedding_size, skipped_nr = [], None, 0
+    with open(raw_filepath, 'wb') as raw_file:
+        for word, vector in word_vectors:
+            if embedding_size is None:
+                embedding_size = len(vector)
+            encoded_word = word.encode('utf-8')
+            if len(vector) != embedding_size or len(encoded_word) > MAX_WORD_BYTES:
+                skipped_nr += 1
+                continue
+            vector = np.asarray(vector, dtype=np.float32)
+            raw_file.write(vector.tobytes())
+            words.append(encoded_word)
+    if not words:
+        shutil.rmtree(tmp_dirpath)
+        raise ValueError('no word vectors to convert')
+    logger.info('read {} word vectors of size {}, skipped {}'.format(len(words), embedding_size, skipped_nr))
+
+    words = np.array(words)
+    order = np.argsort(words, kind='mergesort')
+    sorted_words = words[order]
+    is_last = np.append(sorted_words[1:] != sorted_words[:-1], True)
+    order, sorted_words = order[is_last], sorted_words[is_last]
+
+    raw_vectors = np.memmap(raw_filepath, dtype=np.float32, mode='r', shape=(len(words), embedding_size))
+    vectors = np.lib.format.open_memmap(os.path.join(tmp_dirpath, 'vectors.npy'), mode='w+',
+                                        dtype=np.float32, shape=(len(order), embedding_size))
+    for start in range(0, len(order), CONVERSION_BATCH_SIZE):
+        vectors[start:start + CONVERSION_BATCH_SIZE] = raw_vectors[order[start:start + CONVERSION_BATCH_SIZE]]
+    vectors.flush()
+    del raw_vectors, vectors
+    os.remove(raw_filepath)
+
+    np.save(os.path.join(tmp_dirpath, 'words.npy'), sorted_words)
+    joblib.dump({'embedding_size': embedding_size}, os.path.join(tmp_dirpath, 'stats.pkl'))
+
+    if os.path.isdir(store_dirpath):
+        shutil.rmtree(store_dirpath)
+    os.rename(tmp_dirpath, store_dirpath)
+    logger.info('embedding store with {} words saved to {}'.format(len(order), store_dirpath))
+
+
+def load_converted_weights(model, filepath):
+    """
+    Loads the weights of a model saved with model.save or ModelCheckpoint into model.
+
+    Layers are matched in order, like keras load_weights. Weights saved from CuDNNGRU and
+    CuDNNLSTM layers are converted for GRU(reset_after=True) and LSTM layers, also inside
+    Bidirectional wrappers, so that a model trained on GPU can be served by its CPU twin.
+    """
+    with h5py.File(filepath, mode='r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        saved_weights = []
+        for layer_name in group.attrs['layer_names']:
+            layer_group = group[_decode(layer_name)]
+            weight_names = [_decode(weight_name) for weight_name in layer_group.attrs['weight_names']]
+            if weight_names:
+                saved_weights.append([np.asarray(layer_group[weight_name]) for weight_name in weight_names])
+
+    layers = [layer for layer in model.layers if layer.weights]
+    if len(layers) != len(saved_weights):
+        raise ValueError('model has {} layers with weights but {} were saved in {}'.format(
+            len(layers), len(saved_weights), filepath))
+    for layer, weights in zip(layers, saved_weights):
+        layer.set_weights(convert_rnn_weights(layer, weights))
+
+
+def convert_rnn_weights(layer, weights):
+    """
+    Converts CuDNNGRU and CuDNNLSTM weights for the equivalent plain layer, other weights are
+    returned as they are.
+
+    CuDNN layers keep every gate kernel in the cuDNN memory layout, i.e. kernel[:, gate] holds
+    the row-major (units, input_dim) matrix applied to the input, and separate input and
+    recurrent biases. LSTM adds the two biases, GRU(reset_after=True) keeps them as two rows.
+    """
+    class_name = layer.__class__.__name__
+    if class_name == 'Bidirectional':
+        forward_nr = len(weights) // 2
+        return (convert_rnn_weights(layer.forward_layer, weights[:forward_nr]) +
+                convert_rnn_weights(layer.backward_layer, weights[forward_nr:]))
+    if class_name not in ['GRU', 'LSTM'] or len(weights) != 3:
+        return weights
+
+    kernel, recurrent_kernel, bias = weights
+    unit_nr = recurrent_kernel.shape[0]
+    gate_nr = 3 if class_name == 'GRU' else 4
+    if bias.shape != (2 * gate_nr * unit_nr,):
+        return weights
+    if class_name == 'GRU' and not layer.reset_after:
+        raise ValueError('CuDNNGRU weights can only be loaded into GRU(reset_after=True)')
+
+    kernel = np.hstack([gate_kernel.reshape(unit_nr, -1).T for gate_kernel in np.hsplit(kernel, gate_nr)])
+    recurrent_kernel = np.hstack([gate_kernel.T for gate_kernel in np.hsplit(recurrent_kernel, gate_nr)])
+    if class_name == 'GRU':
+        bias = bias.reshape(2, -1)
+    else:
+        bias = bias[:gate_nr * unit_nr] + bias[gate_nr * unit_nr:]
+    return [kernel, recurrent_kernel, bias]
+
+
+def _decode(name):
+    return name.decode('utf8') if isinstance(name, bytes) else name
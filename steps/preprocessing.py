@@ -1,32 +1,59 @@
+import numbers
+import os
 import re
 import string
+import tempfile
 
 import numpy as np
-import pandas as pd
+from scipy import sparse
 from sklearn.externals import joblib
+from sklearn.externals.joblib import Parallel, delayed
 from sklearn.feature_extraction import text
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.pipeline import make_pipeline
 import sklearn.preprocessing as sk_prep
 
 from .base import BaseTransformer
+from .utils import get_effective_n_jobs, split_into_batches, to_object_array
+
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+MIN_ROWS_PER_JOB = 10000
 
 
 class WordListFilter(BaseTransformer):
-    def __init__(self, word_list_filepath):
+    """
+    Keeps only the words from the word list and counts their occurrences.
+
+    Besides the filtered text X it returns the float32 counts matrix with the
+    BAD_WORD_COUNT_FEATURES columns: whole word matches, occurrences of listed words anywhere
+    inside the words (e.g. in 'motherfucking') and distinct whole word matches.
+    The word list is compiled into a single regex shaped like a trie of the words. Comments
+    repeat the same words over and over, so the regex is run once per distinct word of a batch
+    and the results are looked up afterwards.
+    """
+    chunkable = True
+    main_thread = True
+
+    def __init__(self, word_list_filepath, n_jobs=1):
         self.word_set = self._read_data(word_list_filepath)
+        self.n_jobs = n_jobs
+        self.word_pattern = re.compile(_get_trie_pattern(self.word_set))
 
-    def transform(self, X):
-        X = self._transform(X)
-        return {'X': X}
-
-    def _transform(self, X):
-        X = pd.DataFrame(X, columns=['text']).astype(str)
-        X['text'] = X['text'].apply(self._filter_words)
-        return X['text'].values
+    def fit_partial(self, *args, **kwargs):
+        return self
 
-    def _filter_words(self, x):
-        x = x.lower()
-        x = ' '.join([w for w in x.split() if w in self.word_set])
-        return x
+    def transform(self, X):
+        texts = [str(x) for x in np.asarray(X).ravel()]
+        n_jobs = get_effective_n_jobs(self.n_jobs, len(texts), MIN_ROWS_PER_JOB)
+        if n_jobs > 1:
+            batches = Parallel(n_jobs=n_jobs)(delayed(_filter_batch)(self, batch)
+                                              for batch in split_into_batches(texts, n_jobs))
+        else:
+            batches = [_filter_batch(self, texts)]
+        filtered_texts = [x for batch_texts, _ in batches for x in batch_texts]
+        counts = np.vstack([batch_counts for _, batch_counts in batches])
+        return {'X': to_object_array(filtered_texts),
+                'counts': counts}
 
     def _read_data(self, filepath):
         with open(filepath, 'r+') as f:
@@ -41,59 +68,56 @@ class WordListFilter(BaseTransformer):
 
 
 class TextCleaner(BaseTransformer):
+    chunkable = True
+    main_thread = True
+
     def __init__(self, drop_punctuation, drop_newline, drop_multispaces,
-                 all_lower_case, fill_na_with, deduplication_threshold):
+                 all_lower_case, fill_na_with, deduplication_threshold, n_jobs=1):
         self.drop_punctuation = drop_punctuation
         self.drop_newline = drop_newline
         self.drop_multispaces = drop_multispaces
         self.all_lower_case = all_lower_case
         self.fill_na_with = fill_na_with
         self.deduplication_threshold = deduplication_threshold
+        self.n_jobs = n_jobs
+
+    def fit_partial(self, *args, **kwargs):
+        return self
 
     def transform(self, X):
-        X = pd.DataFrame(X, columns=['text']).astype(str)
-        X['text'] = X['text'].apply(self._transform)
-        if self.fill_na_with:
-            X['text'] = X['text'].fillna(self.fill_na_with).values
-        return {'X': X['text'].values}
+        texts = [str(x) for x in np.asarray(X).ravel()]
+        n_jobs = get_effective_n_jobs(self.n_jobs, len(texts), MIN_ROWS_PER_JOB)
+        if n_jobs > 1:
+            batches = Parallel(n_jobs=n_jobs)(delayed(_clean_batch)(self, batch)
+                                              for batch in split_into_batches(texts, n_jobs))
+            cleaned_texts = [x for batch in batches for x in batch]
+        else:
+            cleaned_texts = _clean_batch(self, texts)
+        return {'X': to_object_array(cleaned_texts)}
 
     def _transform(self, x):
         if self.all_lower_case:
-            x = self._lower(x)
+            x = x.lower()
         if self.drop_punctuation:
-            x = self._remove_punctuation(x)
+            x = PUNCTUATION_PATTERN.sub(' ', x)
         if self.drop_newline:
-            x = self._remove_newline(x)
+            x = x.replace('\n', ' ')
         if self.drop_multispaces:
-            x = self._substitute_multiple_spaces(x)
+            x = ' '.join(x.split())
         if self.deduplication_threshold is not None:
             x = self._deduplicate(x)
         return x
 
-    def _lower(self, x):
-        return x.lower()
-
-    def _remove_punctuation(self, x):
-        return re.sub(r'[^\w\s]', ' ', x)
-
-    def _remove_newline(self, x):
-        x = x.replace('\n', ' ')
-        x = x.replace('\n\n', ' ')
-        return x
-
-    def _substitute_multiple_spaces(self, x):
-        return ' '.join(x.split())
-
-    def _deduplicate(self,x):
+    def _deduplicate(self, x):
         word_list = x.split()
         num_words = len(word_list)
-        if num_words ==0:
+        if num_words == 0:
             return x
         else:
             num_unique_words = len(set(word_list))
-            unique_ratio = num_words/num_unique_words
+            unique_ratio = num_words / num_unique_words
             if unique_ratio > self.deduplication_threshold:
-                x = ' '.join(x.split()[:num_unique_words])
+                x = ' '.join(word_list[:num_unique_words])
             return x
 
     def load(self, filepath):
@@ -112,10 +136,15 @@ class TextCleaner(BaseTransformer):
 
 
 class XYSplit(BaseTransformer):
+    chunkable = True
+
     def __init__(self, x_columns, y_columns):
         self.x_columns = x_columns
         self.y_columns = y_columns
 
+    def fit_partial(self, *args, **kwargs):
+        return self
+
     def transform(self, meta, train_mode):
         X = meta[self.x_columns].values
         if train_mode:
@@ -140,15 +169,137 @@ class XYSplit(BaseTransformer):
 
 
 class TfidfVectorizer(BaseTransformer):
-    def __init__(self, **kwargs):
-        self.vectorizer = text.TfidfVectorizer(**kwargs)
+    """
+    Note:
+        With use_hashing=True the vocabulary is replaced by feature hashing into
+        hashing_n_features columns followed by a TfidfTransformer, so fitting only learns the
+        idf vector. Fit memory no longer grows with the vocabulary, the saved artifact is small
+        and transform needs no state besides the idf. hashing_n_features should be a power of
+        two well above the number of distinct terms, as colliding terms share a column.
+        The features differ from the vocabulary mode: every term is kept instead of the
+        max_features most frequent ones, and the column order is given by the hash. max_df,
+        min_df, max_features and vocabulary have no effect in this mode.
+        Features are returned as dtype (float32 by default) CSR matrices.
+        With n_jobs > 1 large inputs are transformed in one row batch per joblib worker, which
+        loads the fitted vectorizer from a temporary file dumped once per transform call. On a
+        single job, e.g. off the main thread, the vectorizer is applied directly.
+        fit_partial accumulates document and term frequencies chunk by chunk and
+        finish_partial_fit selects the vocabulary and computes the idf, which gives the same
+        vectorizer as fit on the concatenated chunks. When more than partial_vocabulary_limit
+        terms are tracked, the rarest ones are pruned with a growing document frequency
+        threshold, so the result becomes approximate for the pruned terms.
+    """
+    chunkable = True
+    main_thread = True
+
+    def __init__(self, use_hashing=False, hashing_n_features=2 ** 20, n_jobs=1, partial_vocabulary_limit=2 ** 22,
+                 dtype=np.float32, **kwargs):
+        self.use_hashing = use_hashing
+        self.hashing_n_features = hashing_n_features
+        self.n_jobs = n_jobs
+        self.partial_vocabulary_limit = partial_vocabulary_limit
+        self.dtype = dtype
+        if use_hashing:
+            self.vectorizer = _get_hashing_tfidf_vectorizer(n_features=hashing_n_features, dtype=dtype, **kwargs)
+        else:
+            self.vectorizer = text.TfidfVectorizer(dtype=dtype, **kwargs)
+        self._reset_partial_fit()
 
     def fit(self, text):
         self.vectorizer.fit(text)
         return self
 
+    def fit_partial(self, text):
+        if self.document_frequencies is None:
+            self._init_partial_fit()
+        if self.use_hashing:
+            counts = self.vectorizer.steps[0][1].transform(text)
+            counts.sum_duplicates()
+            self.document_frequencies += np.bincount(counts.indices, minlength=counts.shape[1])
+        else:
+            counter = CountVectorizer(analyzer=self.vectorizer.build_analyzer(), dtype=np.int64)
+            counts = counter.fit_transform(text).tocsr()
+            chunk_document_frequencies = np.bincount(counts.indices, minlength=counts.shape[1])
+            chunk_term_frequencies = np.asarray(counts.sum(axis=0)).ravel()
+            for term, index in counter.vocabulary_.items():
+                document_frequency, term_frequency = self.document_frequencies.get(term, (0, 0))
+                self.document_frequencies[term] = (document_frequency + chunk_document_frequencies[index],
+                                                   term_frequency + chunk_term_frequencies[index])
+            if len(self.document_frequencies) > self.partial_vocabulary_limit:
+                self._prune_rare_terms()
+        self.document_nr += counts.shape[0]
+        return self
+
+    def finish_partial_fit(self):
+        if self.use_hashing:
+            tfidf_transformer = self.vectorizer.steps[1][1]
+            document_frequencies = self.document_frequencies
+        else:
+            tfidf_transformer = self.vectorizer
+            vocabulary, document_frequencies = self._limit_partial_vocabulary()
+            self.vectorizer.vocabulary_ = vocabulary
+            self.vectorizer.fixed_vocabulary_ = False
+            self.vectorizer.stop_words_ = set()
+        if tfidf_transformer.use_idf:
+            _set_idf(tfidf_transformer, _get_idf(document_frequencies, self.document_nr, tfidf_transformer.smooth_idf))
+        self._reset_partial_fit()
+        return self
+
+    def _reset_partial_fit(self):
+        self.document_frequencies = None
+        self.document_nr = 0
+        self.prune_threshold = 1
+
+    def _init_partial_fit(self):
+        if self.use_hashing:
+            self.document_frequencies = np.zeros(self.vectorizer.steps[0][1].n_features, dtype=np.int64)
+        else:
+            self.document_frequencies = {}
+
+    def _prune_rare_terms(self):
+        while len(self.document_frequencies) > self.partial_vocabulary_limit:
+            self.document_frequencies = {term: frequencies for term, frequencies in self.document_frequencies.items()
+                                         if frequencies[0] > self.prune_threshold}
+            self.prune_threshold += 1
+
+    def _limit_partial_vocabulary(self):
+        """
+        Mirrors sklearn's max_df, min_df and max_features selection on the accumulated counts.
+        """
+        terms = np.array(sorted(self.document_frequencies), dtype=object)
+        frequencies = np.array([self.document_frequencies[term] for term in terms], dtype=np.int64).reshape(-1, 2)
+        document_frequencies, term_frequencies = frequencies[:, 0], frequencies[:, 1]
+
+        max_df, min_df, max_features = self.vectorizer.max_df, self.vectorizer.min_df, self.vectorizer.max_features
+        max_doc_count = max_df if isinstance(max_df, numbers.Integral) else max_df * self.document_nr
+        min_doc_count = min_df if isinstance(min_df, numbers.Integral) else min_df * self.document_nr
+        mask = (document_frequencies <= max_doc_count) & (document_frequencies >= min_doc_count)
+        if max_features is not None and mask.sum() > max_features:
+            mask_indices = (-term_frequencies[mask]).argsort()[:max_features]
+            new_mask = np.zeros(len(mask), dtype=bool)
+            new_mask[np.where(mask)[0][mask_indices]] = True
+            mask = new_mask
+        if not mask.any():
+            raise ValueError('After pruning, no terms remain. Try a lower min_df or a higher max_df.')
+
+        vocabulary = {term: index for index, term in enumerate(terms[mask])}
+        return vocabulary, document_frequencies[mask]
+
     def transform(self, text):
-        return {'features': self.vectorizer.transform(text)}
+        n_jobs = get_effective_n_jobs(self.n_jobs, len(text), MIN_ROWS_PER_JOB)
+        if n_jobs > 1:
+            features = self._parallel_transform(text, n_jobs)
+        else:
+            features = self.vectorizer.transform(text)
+        return {'features': features.astype(self.dtype, copy=False)}
+
+    def _parallel_transform(self, text, n_jobs):
+        with tempfile.TemporaryDirectory() as dirpath:
+            vectorizer_filepath = os.path.join(dirpath, 'vectorizer.pkl')
+            joblib.dump(self.vectorizer, vectorizer_filepath)
+            batches = Parallel(n_jobs=n_jobs)(delayed(_vectorize_batch)(vectorizer_filepath, batch)
+                                              for batch in split_into_batches(text, n_jobs))
+        return sparse.vstack(batches, format='csr')
 
     def load(self, filepath):
         self.vectorizer = joblib.load(filepath)
@@ -159,31 +310,14 @@ class TfidfVectorizer(BaseTransformer):
 
 
 class TextCounter(BaseTransformer):
-    def transform(self, X):
-        X = pd.DataFrame(X, columns=['text']).astype(str)
-        X = X['text'].apply(self._transform)
-        X['caps_vs_length'] = X.apply(lambda row: float(row['upper_case_count']) / float(row['char_count']), axis=1)
-        X['num_symbols'] = X['text'].apply(lambda comment: sum(comment.count(w) for w in '*&$%'))
-        X['num_words'] = X['text'].apply(lambda comment: len(comment.split()))
-        X['num_unique_words'] = X['text'].apply(lambda comment: len(set(w for w in comment.split())))
-        X['words_vs_unique'] = X['num_unique_words'] / X['num_words']
-        X['mean_word_len'] = X['text'].apply(lambda x: np.mean([len(w) for w in str(x).split()]))
-        X.drop('text', axis=1, inplace=True)
-        X.fillna(0.0, inplace=True)
-        return {'X': X}
+    chunkable = True
 
-    def _transform(self, x):
-        features = {}
-        features['text'] = x
-        features['char_count'] = char_count(x)
-        features['word_count'] = word_count(x)
-        features['punctuation_count'] = punctuation_count(x)
-        features['upper_case_count'] = upper_case_count(x)
-        features['lower_case_count'] = lower_case_count(x)
-        features['digit_count'] = digit_count(x)
-        features['space_count'] = space_count(x)
-        features['newline_count'] = newline_count(x)
-        return pd.Series(features)
+    def fit_partial(self, *args, **kwargs):
+        return self
+
+    def transform(self, X):
+        texts = [str(x) for x in np.asarray(X).ravel()]
+        return {'X': count_features(texts)}
 
     def load(self, filepath):
         return self
@@ -193,6 +327,8 @@ class TextCounter(BaseTransformer):
 
 
 class Normalizer(BaseTransformer):
+    chunkable = True
+
     def __init__(self):
         self.normalizer = sk_prep.Normalizer()
 
@@ -200,6 +336,9 @@ class Normalizer(BaseTransformer):
         self.normalizer.fit(X)
         return self
 
+    def fit_partial(self, X):
+        return self.fit(X)
+
     def transform(self, X):
         X = self.normalizer.transform(X)
         return {'X': X}
@@ -212,37 +351,169 @@ class Normalizer(BaseTransformer):
         joblib.dump(self.normalizer, filepath)
 
 
-def char_count(x):
-    return len(x)
-
-
-def word_count(x):
-    return len(x.split())
-
-
-def newline_count(x):
-    return x.count('\n')
-
-
-def upper_case_count(x):
-    return sum(c.isupper() for c in x)
-
-
-def lower_case_count(x):
-    return sum(c.islower() for c in x)
-
-
-def digit_count(x):
-    return sum(c.isdigit() for c in x)
-
-
-def space_count(x):
-    return sum(c.isspace() for c in x)
-
-
-def punctuation_count(x):
-    return occurence(x, string.punctuation)
-
-
-def occurence(s1, s2):
-    return sum([1 for x in s1 if x in s2])
+def _get_hashing_tfidf_vectorizer(n_features, norm='l2', use_idf=True, smooth_idf=True, sublinear_tf=False,
+                                  max_df=None, min_df=None, max_features=None, vocabulary=None, **kwargs):
+    hashing_vectorizer = text.HashingVectorizer(n_features=n_features, alternate_sign=False, norm=None, **kwargs)
+    tfidf_transformer = text.TfidfTransformer(norm=norm, use_idf=use_idf, smooth_idf=smooth_idf,
+                                              sublinear_tf=sublinear_tf)
+    return make_pipeline(hashing_vectorizer, tfidf_transformer)
+
+
+def _get_idf(document_frequencies, document_nr, smooth_idf):
+    document_frequencies = document_frequencies.astype(np.float64) + int(smooth_idf)
+    return np.log((document_nr + int(smooth_idf)) / document_frequencies) + 1.0
+
+
+def _set_idf(tfidf_transformer, idf):
+    try:
+        tfidf_transformer.idf_ = idf
+    except AttributeError:
+        tfidf_transformer = getattr(tfidf_transformer, '_tfidf', tfidf_transformer)
+        tfidf_transformer._idf_diag = sparse.spdiags(idf, diags=0, m=len(idf), n=len(idf), format='csr')
+
+
+def _vectorize_batch(vectorizer_filepath, texts):
+    return joblib.load(vectorizer_filepath).transform(texts)
+
+
+def _clean_batch(text_cleaner, texts):
+    return [text_cleaner._transform(x) for x in texts]
+
+
+def _filter_batch(word_list_filter, texts):
+    word_set = word_list_filter.word_set
+    substring_counts = _SubstringCounts(word_list_filter.word_pattern)
+    filtered_texts, counts = [], []
+    for x in texts:
+        words = x.lower().split()
+        matched_words = [w for w in words if w in word_set]
+        filtered_texts.append(' '.join(matched_words))
+        counts.append((len(matched_words), sum(map(substring_counts.__getitem__, words)), len(set(matched_words))))
+    return filtered_texts, np.array(counts, dtype=np.float32).reshape(-1, len(BAD_WORD_COUNT_FEATURES))
+
+
+class _SubstringCounts(dict):
+    def __init__(self, word_pattern):
+        super().__init__()
+        self.word_pattern = word_pattern
+
+    def __missing__(self, word):
+        self[word] = len(self.word_pattern.findall(word))
+        return self[word]
+
+
+def _get_trie_pattern(words):
+    """
+    Builds a regex alternation shaped like a trie of the words, e.g. ['ass', 'asshole', 'arse']
+    gives 'a(?:rse|ss(?:hole)?)'. Longer words are tried first so the longest match wins.
+    """
+    trie = {}
+    for word in filter(None, words):
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+    return _trie_to_pattern(trie)
+
+
+def _trie_to_pattern(node):
+    branches = [re.escape(char) + _trie_to_pattern(child) for char, child in sorted(node.items()) if char]
+    if not branches:
+        return ''
+    pattern = branches[0] if len(branches) == 1 else '(?:{})'.format('|'.join(branches))
+    if '' in node:
+        pattern = '(?:{})?'.format(pattern)
+    return pattern
+
+
+def count_features(texts):
+    """
+    Computes the TEXT_COUNTER_FEATURES matrix (float32, one row per text) for all texts at once.
+
+    The texts are concatenated into a single array of unicode code points. Character classes
+    come from a lookup table for ASCII and from str methods evaluated once per distinct
+    non-ASCII code point, and are summed per text with np.bincount. Only the unique word count
+    needs a per-text python pass.
+    """
+    lengths = np.array([len(x) for x in texts], dtype=np.int64)
+    codes = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    row_ids = np.repeat(np.arange(len(texts)), lengths)
+    char_classes = _get_char_classes(codes)
+
+    def count(char_class):
+        return np.bincount(row_ids, weights=(char_classes & char_class) > 0, minlength=len(texts))
+
+    space = (char_classes & SPACE) > 0
+    row_starts = np.zeros(len(codes), dtype=bool)
+    row_starts[np.cumsum(lengths)[:-1][lengths[1:] > 0]] = True
+    if len(codes):
+        row_starts[0] = True
+    previous_space = np.empty(len(codes), dtype=bool)
+    previous_space[1:] = space[:-1]
+    word_starts = ~space & (row_starts | previous_space)
+
+    char_count = lengths.astype(np.float64)
+    space_count = count(SPACE)
+    upper_case_count = count(UPPER)
+    word_count = np.bincount(row_ids, weights=word_starts, minlength=len(texts))
+    num_unique_words = np.array([len(set(x.split())) for x in texts], dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features = {'char_count': char_count,
+                    'digit_count': count(DIGIT),
+                    'lower_case_count': count(LOWER),
+                    'newline_count': count(NEWLINE),
+                    'punctuation_count': count(PUNCTUATION),
+                    'space_count': space_count,
+                    'upper_case_count': upper_case_count,
+                    'word_count': word_count,
+                    'caps_vs_length': upper_case_count / char_count,
+                    'num_symbols': count(SYMBOL),
+                    'num_words': word_count,
+                    'num_unique_words': num_unique_words,
+                    'words_vs_unique': num_unique_words / word_count,
+                    'mean_word_len': (char_count - space_count) / word_count,
+                    }
+    X = np.stack([features[name] for name in TEXT_COUNTER_FEATURES], axis=1)
+    X[~np.isfinite(X)] = 0.0
+    return X.astype(np.float32)
+
+
+def _get_char_classes(codes):
+    char_classes = np.zeros(len(codes), dtype=np.uint8)
+    is_ascii = codes < 128
+    char_classes[is_ascii] = ASCII_CHAR_CLASSES[codes[is_ascii]]
+    if not is_ascii.all():
+        non_ascii_codes = codes[~is_ascii]
+        unique_codes, inverse = np.unique(non_ascii_codes, return_inverse=True)
+        unique_classes = np.array([_get_char_class(chr(code)) for code in unique_codes], dtype=np.uint8)
+        char_classes[~is_ascii] = unique_classes[inverse]
+    return char_classes
+
+
+def _get_char_class(c):
+    char_class = 0
+    if c.isupper():
+        char_class |= UPPER
+    if c.islower():
+        char_class |= LOWER
+    if c.isdigit():
+        char_class |= DIGIT
+    if c.isspace():
+        char_class |= SPACE
+    if c in string.punctuation:
+        char_class |= PUNCTUATION
+    if c in '*&$%':
+        char_class |= SYMBOL
+    if c == '\n':
+        char_class |= NEWLINE
+    return char_class
+
+
+UPPER, LOWER, DIGIT, SPACE, PUNCTUATION, SYMBOL, NEWLINE = 1, 2, 4, 8, 16, 32, 64
+ASCII_CHAR_CLASSES = np.array([_get_char_class(chr(code)) for code in range(128)], dtype=np.uint8)
+BAD_WORD_COUNT_FEATURES = ['bad_word_count', 'bad_word_substring_count', 'unique_bad_word_count']
+TEXT_COUNTER_FEATURES = ['char_count', 'digit_count', 'lower_case_count', 'newline_count', 'punctuation_count',
+                         'space_count', 'upper_case_count', 'word_count',
+                         'caps_vs_length', 'num_symbols', 'num_words', 'num_unique_words', 'words_vs_unique',
+                         'mean_word_len']
@@ -1,8 +1,16 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+
 import numpy as np
+from scipy import sparse
+from scipy.special import expit
 import sklearn.linear_model as lr
 from sklearn import svm
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.externals import joblib
+from sklearn.externals.joblib import Parallel, delayed
 from catboost import CatBoostClassifier
 
 from steps.base import BaseTransformer
@@ -12,14 +20,31 @@ logger = get_logger()
 
 
 class MultilabelEstimator(BaseTransformer):
-    def __init__(self, label_nr, **kwargs):
+    """
+    Note:
+        With label_n_jobs > 1 the per-label estimators are fitted in parallel joblib workers.
+        X is dumped once to a temporary file and memory-mapped by every worker instead of
+        being pickled for each label. X is cast to fit_dtype, the dtype the estimator
+        converts its input to, before that, so the workers do not each make a copy.
+        joblib runs serially outside the main thread and in its own workers, in which case
+        the labels are fitted one after the other.
+    """
+    chunkable = True
+    main_thread = True
+    fit_dtype = np.float64
+
+    def __init__(self, label_nr, label_n_jobs=1, **kwargs):
         self.label_nr = label_nr
-        self.estimators = self._get_estimators(**kwargs)
+        self.label_n_jobs = label_n_jobs
+        self.estimators = self._get_estimators(**self._get_estimator_params(**kwargs))
 
     @property
     def estimator(self):
         return NotImplementedError
 
+    def _get_estimator_params(self, **kwargs):
+        return kwargs
+
     def _get_estimators(self, **kwargs):
         estimators = []
         for i in range(self.label_nr):
@@ -27,12 +52,38 @@ class MultilabelEstimator(BaseTransformer):
         return estimators
 
     def fit(self, X, y, **kwargs):
-        for i, estimator in self.estimators:
-            logger.info('fitting estimator {}'.format(i))
-            estimator.fit(X, y[:, i])
+        X = _to_csr(X)
+        if self.fit_dtype is not None:
+            X = X.astype(self.fit_dtype, copy=False)
+        label_n_jobs = self._get_label_n_jobs()
+        self._prepare_estimators(label_n_jobs)
+        if label_n_jobs > 1:
+            self._parallel_fit(X, y, label_n_jobs)
+        else:
+            for i, estimator in self.estimators:
+                logger.info('fitting estimator {}'.format(i))
+                estimator.fit(X, y[:, i])
         return self
 
+    def _get_label_n_jobs(self):
+        if threading.current_thread() is not threading.main_thread() or multiprocessing.current_process().daemon:
+            return 1
+        return max(1, min(self.label_n_jobs, self.label_nr))
+
+    def _prepare_estimators(self, label_n_jobs):
+        pass
+
+    def _parallel_fit(self, X, y, label_n_jobs):
+        logger.info('fitting {} estimators with {} jobs'.format(len(self.estimators), label_n_jobs))
+        with tempfile.TemporaryDirectory() as dirpath:
+            X_filepath = os.path.join(dirpath, 'X.pkl')
+            joblib.dump(X, X_filepath)
+            estimators = Parallel(n_jobs=label_n_jobs)(delayed(_fit_estimator)(estimator, X_filepath, y[:, i])
+                                                            for i, estimator in self.estimators)
+        self.estimators = [(i, estimator) for (i, _), estimator in zip(self.estimators, estimators)]
+
     def transform(self, X, y=None, **kwargs):
+        X = _to_csr(X)
         predictions = []
         for i, estimator in self.estimators:
             prediction = estimator.predict_proba(X)
@@ -54,10 +105,47 @@ class MultilabelEstimator(BaseTransformer):
 
 
 class LogisticRegressionMultilabel(MultilabelEstimator):
+    """
+    Note:
+        Once fitted, the per-label models are stacked into a (features x labels) coef matrix
+        and an intercept vector. transform is then a single matrix product followed by a
+        sigmoid with float32 output, and only these two arrays are saved.
+    """
+
     @property
     def estimator(self):
         return lr.LogisticRegression
 
+    def fit(self, X, y, **kwargs):
+        super().fit(X, y, **kwargs)
+        self._stack_coefficients()
+        return self
+
+    def transform(self, X, y=None, **kwargs):
+        scores = X.dot(self.coef) + self.intercept
+        return {'prediction_probability': expit(scores).astype(np.float32)}
+
+    def _stack_coefficients(self):
+        self.coef = np.stack([estimator.coef_.ravel() for _, estimator in self.estimators], axis=1).astype(np.float32)
+        self.intercept = np.array([estimator.intercept_[0] for _, estimator in self.estimators], dtype=np.float32)
+
+    def load(self, filepath):
+        params = joblib.load(filepath)
+        self.label_nr = params['label_nr']
+        if 'coef' in params:
+            self.coef = params['coef']
+            self.intercept = params['intercept']
+        else:
+            self.estimators = params['estimators']
+            self._stack_coefficients()
+        return self
+
+    def save(self, filepath):
+        params = {'label_nr': self.label_nr,
+                  'coef': self.coef,
+                  'intercept': self.intercept}
+        joblib.dump(params, filepath)
+
 
 class SVCMultilabel(MultilabelEstimator):
     @property
@@ -87,12 +175,42 @@ class LinearSVCMultilabel(MultilabelEstimator):
 
 
 class RandomForestMultilabel(MultilabelEstimator):
+    fit_dtype = np.float32
+
     @property
     def estimator(self):
         return RandomForestClassifier
 
 
 class CatboostClassifierMultilabel(MultilabelEstimator):
+    """
+    Note:
+        The thread_count threads (all cores by default) are split between the labels fitted
+        at the same time, which is set on the estimators right before fit.
+    """
+    fit_dtype = None
+
     @property
     def estimator(self):
         return CatBoostClassifier
+
+    def _get_estimator_params(self, **kwargs):
+        self.thread_count = kwargs.pop('thread_count', multiprocessing.cpu_count())
+        if self.thread_count == -1:
+            self.thread_count = multiprocessing.cpu_count()
+        return kwargs
+
+    def _prepare_estimators(self, label_n_jobs):
+        for _, estimator in self.estimators:
+            estimator.set_params(thread_count=max(1, self.thread_count // label_n_jobs))
+
+
+def _fit_estimator(estimator, X_filepath, y):
+    X = joblib.load(X_filepath, mmap_mode='r')
+    return estimator.fit(X, y)
+
+
+def _to_csr(X):
+    if sparse.issparse(X):
+        return X.tocsr()
+    return X
@@ -1,8 +1,19 @@
+import hashlib
 import logging
+import multiprocessing
 import os
+import shutil
+import tempfile
+import threading
 
+import numpy as np
+import pandas as pd
 import pydot_ng as pydot
+from scipy import sparse
 from IPython.display import Image, display
+from sklearn.externals import joblib
+
+RUNTIME_PARAMS = ['n_jobs', 'label_n_jobs', 'thread_count']
 
 
 def view_pydot(pydot_object):
@@ -34,6 +45,133 @@ def create_filepath(filepath):
     os.makedirs(dirpath, exist_ok=True)
 
 
+def save_step_output(output_data, dirpath):
+    """
+    Saves a step output dict as one file per entry so that it can be memory-mapped on load.
+
+    Dense numeric arrays are stored as .npy, scipy sparse matrices as CSR data/indices/indptr .npy
+    files and everything else (text arrays, DataFrames, python objects) is pickled with joblib.
+    The directory is written under a temporary name and renamed, so a partially written output
+    is never picked up as cached.
+    """
+    tmp_dirpath = tempfile.mkdtemp(dir=os.path.dirname(dirpath), prefix='.tmp_')
+    if isinstance(output_data, dict):
+        index = {}
+        for i, (key, value) in enumerate(output_data.items()):
+            index[key] = _save_value(value, os.path.join(tmp_dirpath, str(i)))
+    else:
+        index = None
+        joblib.dump(output_data, os.path.join(tmp_dirpath, 'output.pkl'))
+    joblib.dump(index, os.path.join(tmp_dirpath, 'index.pkl'))
+
+    if os.path.isdir(dirpath):
+        shutil.rmtree(dirpath)
+    os.rename(tmp_dirpath, dirpath)
+
+
+def load_step_output(dirpath, mmap_mode='c'):
+    index = joblib.load(os.path.join(dirpath, 'index.pkl'))
+    if index is None:
+        return joblib.load(os.path.join(dirpath, 'output.pkl'))
+    output_data = {}
+    for key, value_info in index.items():
+        output_data[key] = _load_value(value_info, mmap_mode, dirpath)
+    return output_data
+
+
+def _save_value(value, filepath_prefix):
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        filepath = '{}.npy'.format(filepath_prefix)
+        np.save(filepath, value)
+        return {'format': 'npy', 'filepath': os.path.basename(filepath)}
+    elif sparse.issparse(value):
+        csr_value = value.tocsr()
+        filepaths = {}
+        for component in ['data', 'indices', 'indptr']:
+            filepath = '{}_{}.npy'.format(filepath_prefix, component)
+            np.save(filepath, getattr(csr_value, component))
+            filepaths[component] = os.path.basename(filepath)
+        return {'format': 'sparse',
+                'sparse_format': value.getformat(),
+                'shape': csr_value.shape,
+                'filepaths': filepaths}
+    else:
+        filepath = '{}.pkl'.format(filepath_prefix)
+        joblib.dump(value, filepath)
+        return {'format': 'pickle', 'filepath': os.path.basename(filepath)}
+
+
+def _load_value(value_info, mmap_mode, dirpath):
+    if value_info['format'] == 'npy':
+        return np.load(os.path.join(dirpath, value_info['filepath']), mmap_mode=mmap_mode)
+    elif value_info['format'] == 'sparse':
+        components = [np.load(os.path.join(dirpath, value_info['filepaths'][component]), mmap_mode=mmap_mode)
+                      for component in ['data', 'indices', 'indptr']]
+        value = sparse.csr_matrix(tuple(components), shape=value_info['shape'], copy=False)
+        if value_info['sparse_format'] != 'csr':
+            value = value.asformat(value_info['sparse_format'])
+        return value
+    elif value_info['format'] == 'pickle':
+        return joblib.load(os.path.join(dirpath, value_info['filepath']))
+    else:
+        raise NotImplementedError('unknown output format {}'.format(value_info['format']))
+
+
+def get_effective_n_jobs(n_jobs, row_nr, min_rows_per_job):
+    """
+    Returns the number of joblib workers worth starting for row_nr rows, 1 meaning the caller
+    should do the work itself. joblib runs serially off the main thread and in daemon processes,
+    where starting Parallel would only add the cost of moving the data around.
+    """
+    if threading.current_thread() is not threading.main_thread() or multiprocessing.current_process().daemon:
+        return 1
+    return max(1, min(n_jobs, row_nr // min_rows_per_job))
+
+
+def split_into_batches(sequence, batch_nr):
+    batch_size = int(np.ceil(len(sequence) / batch_nr))
+    return [sequence[i:i + batch_size] for i in range(0, len(sequence), batch_size)]
+
+
+def to_object_array(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def csr_hstack(blocks):
+    """
+    Stacks sparse and dense blocks horizontally straight into a csr_matrix.
+
+    Every block is converted to CSR (a no-op for CSR blocks) and the data and indices arrays of
+    the result are filled row-wise with vectorized numpy indexing, instead of going through
+    COO as scipy.sparse.hstack does. Rows keep sorted indices if the blocks have them.
+    """
+    blocks = [sparse.csr_matrix(block) for block in blocks]
+    row_nr = blocks[0].shape[0]
+    if any(block.shape[0] != row_nr for block in blocks):
+        raise ValueError('blocks have different numbers of rows {}'.format([block.shape[0] for block in blocks]))
+
+    row_lengths = [np.diff(block.indptr) for block in blocks]
+    indptr = np.zeros(row_nr + 1, dtype=np.int64)
+    np.cumsum(np.sum(row_lengths, axis=0), out=indptr[1:])
+    column_nr = sum(block.shape[1] for block in blocks)
+    index_dtype = np.int64 if max(indptr[-1], column_nr) > np.iinfo(np.int32).max else np.int32
+
+    data = np.empty(indptr[-1], dtype=np.result_type(*[block.dtype for block in blocks]))
+    indices = np.empty(indptr[-1], dtype=index_dtype)
+    row_offsets = indptr[:-1].copy()
+    column_offset = 0
+    for block, lengths in zip(blocks, row_lengths):
+        block_nnz = block.indptr[-1]
+        positions = np.repeat(row_offsets - block.indptr[:-1], lengths) + np.arange(block_nnz)
+        data[positions] = block.data[:block_nnz]
+        indices[positions] = block.indices[:block_nnz] + column_offset
+        row_offsets += lengths
+        column_offset += block.shape[1]
+    return sparse.csr_matrix((data, indices, indptr.astype(index_dtype)), shape=(row_nr, column_nr))
+
+
 def init_logger():
     logger = logging.getLogger('steps')
     logger.setLevel(logging.INFO)
@@ -52,3 +190,66 @@ def init_logger():
 
 def get_logger():
     return logging.getLogger('steps')
+
+
+def fingerprint(obj):
+    """
+    Deterministic sha1 hex digest of configs and data.
+
+    Handles plain python containers, numpy arrays, pandas objects, scipy sparse matrices,
+    sklearn-like estimators (through get_params) and arbitrary objects through their __dict__.
+    RUNTIME_PARAMS of estimators and objects only set the parallelism and are left out, so
+    changing num_workers keeps the cached transformers and outputs. Callables are identified
+    by their module and qualified name.
+    """
+    sha = hashlib.sha1()
+    _update_fingerprint(sha, obj)
+    return sha.hexdigest()
+
+
+def _update_fingerprint(sha, obj):
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes)):
+        sha.update(repr(obj).encode())
+    elif isinstance(obj, dict):
+        sha.update(b'dict')
+        for key in sorted(obj, key=repr):
+            _update_fingerprint(sha, key)
+            _update_fingerprint(sha, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        sha.update(type(obj).__name__.encode())
+        for element in obj:
+            _update_fingerprint(sha, element)
+    elif isinstance(obj, (set, frozenset)):
+        sha.update(b'set')
+        for element_fingerprint in sorted(fingerprint(element) for element in obj):
+            sha.update(element_fingerprint.encode())
+    elif isinstance(obj, np.ndarray):
+        sha.update('ndarray{}{}'.format(obj.dtype, obj.shape).encode())
+        if obj.dtype == object:
+            sha.update(pd.util.hash_array(obj.ravel()).tobytes())
+        else:
+            sha.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        sha.update(type(obj).__name__.encode())
+        if isinstance(obj, pd.DataFrame):
+            _update_fingerprint(sha, list(obj.columns))
+        sha.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    elif sparse.issparse(obj):
+        obj = obj.tocsr()
+        sha.update('sparse{}{}'.format(obj.dtype, obj.shape).encode())
+        for array in [obj.data, obj.indices, obj.indptr]:
+            sha.update(np.ascontiguousarray(array).tobytes())
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        sha.update('{}.{}'.format(getattr(obj, '__module__', ''), obj.__qualname__).encode())
+    elif hasattr(obj, 'get_params'):
+        sha.update(type(obj).__qualname__.encode())
+        _update_fingerprint(sha, _drop_runtime_params(obj.get_params()))
+    elif hasattr(obj, '__dict__'):
+        sha.update(type(obj).__qualname__.encode())
+        _update_fingerprint(sha, _drop_runtime_params(vars(obj)))
+    else:
+        sha.update(repr(obj).encode())
+
+
+def _drop_runtime_params(params):
+    return {key: value for key, value in params.items() if key not in RUNTIME_PARAMS}
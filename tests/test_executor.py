@@ -0,0 +1,97 @@
+import threading
+
+import numpy as np
+import pytest
+from sklearn.externals import joblib
+
+from steps.base import Step, BaseTransformer
+from steps.executor import Executor
+
+
+class ThreadRecorder(BaseTransformer):
+    def __init__(self, main_thread):
+        self.main_thread = main_thread
+        self.thread_names = []
+
+    def transform(self, X):
+        self.thread_names.append(threading.current_thread().name)
+        return {'X': X + 1}
+
+    def save(self, filepath):
+        joblib.dump({}, filepath)
+
+    def load(self, filepath):
+        return self
+
+
+def test_main_thread_steps_run_on_calling_thread(tmpdir):
+    steps = []
+    for i, main_thread in enumerate([True, False, True, False]):
+        steps.append(Step(name='step_{}'.format(i),
+                          transformer=ThreadRecorder(main_thread),
+                          input_steps=steps[-1:],
+                          input_data=[] if steps else ['input'],
+                          adapter=None if steps else {'X': ([('input', 'X')])},
+                          cache_dirpath=str(tmpdir)))
+
+    output = steps[-1].fit_transform({'input': {'X': np.zeros(2)}}, num_workers=4)
+
+    np.testing.assert_allclose(output['X'], [4, 4])
+    calling_thread_name = threading.current_thread().name
+    for step in steps:
+        assert step.transformer.thread_names
+        assert all((thread_name == calling_thread_name) == step.transformer.main_thread
+                   for thread_name in step.transformer.thread_names)
+
+
+def test_stream_through_embeddings_and_keras_classifier(tmpdir):
+    pytest.importorskip('keras')
+    from steps.keras.models import ClassifierXY, EmbeddingsMatrix
+
+    class OnesEmbeddingsMatrix(EmbeddingsMatrix):
+        def _get_embedding_matrix(self, tokenizer):
+            return np.ones((3, 2))
+
+    class RowSumModel:
+        def predict(self, X, **kwargs):
+            return X.sum(axis=1, keepdims=True)
+
+    class RowSumClassifier(ClassifierXY):
+        def fit(self, embedding_matrix, X):
+            self.model = RowSumModel()
+            return self
+
+        def transform(self, embedding_matrix, X):
+            return super().transform(X)
+
+        def save(self, filepath):
+            joblib.dump({}, filepath)
+
+        def load(self, filepath):
+            self.model = RowSumModel()
+            return self
+
+    def pipeline():
+        embeddings = Step(name='embeddings',
+                          transformer=OnesEmbeddingsMatrix(pretrained_filepath=None, max_features=3,
+                                                           embedding_size=2),
+                          input_data=['input'],
+                          adapter={'tokenizer': ([('input', 'X')])},
+                          cache_dirpath=str(tmpdir))
+        return Step(name='classifier',
+                    transformer=RowSumClassifier(architecture_config={'model_params': {}},
+                                                 training_config={}, callbacks_config={}),
+                    input_steps=[embeddings],
+                    input_data=['input'],
+                    adapter={'embedding_matrix': ([('embeddings', 'embeddings_matrix')]),
+                             'X': ([('input', 'X')]),
+                             },
+                    cache_dirpath=str(tmpdir))
+
+    X = np.arange(12.0).reshape(6, 2)
+    pipeline().fit_transform({'input': {'X': X}})
+
+    output_pipeline = pipeline()
+    chunk_outputs = Executor().stream([output_pipeline], ({'input': {'X': X_chunk}} for X_chunk in np.split(X, 3)))
+    predictions = np.vstack([output[output_pipeline.name]['prediction_probability'] for output in chunk_outputs])
+    np.testing.assert_allclose(predictions, X.sum(axis=1, keepdims=True))
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+pytest.importorskip('h5py')
+
+from keras import backend as K
+from keras.layers import Input, GRU, LSTM
+from keras.models import Model
+
+from models import cudnn_gru, cudnn_lstm
+from steps.keras.utils import load_converted_weights, convert_rnn_weights
+
+MODEL_PARAMS = {'embedding_matrix': None,
+                'embedding_size': 8,
+                'trainable_embedding': False,
+                'maxlen': 10,
+                'max_features': 50,
+                'unit_nr': 4,
+                'repeat_block': 1,
+                'dense_size': 8,
+                'repeat_dense': 1,
+                'max_pooling': True,
+                'mean_pooling': True,
+                'weighted_average_attention': False,
+                'concat_mode': 'concat',
+                'dropout_embedding': 0.0,
+                'rnn_dropout': 0.0,
+                'dense_dropout': 0.0,
+                'dropout_mode': 'simple',
+                'rnn_kernel_reg_l2': 0.0,
+                'rnn_recurrent_reg_l2': 0.0,
+                'rnn_bias_reg_l2': 0.0,
+                'dense_kernel_reg_l2': 0.0,
+                'dense_bias_reg_l2': 0.0,
+                'use_prelu': False,
+                'use_batch_norm': False,
+                'batch_norm_first': False,
+                }
+TIMESTEP_NR, INPUT_DIM, UNIT_NR = 6, 5, 4
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def _cudnn_gates(kernel, recurrent_kernel, gate_nr):
+    kernels = [gate_kernel.reshape(UNIT_NR, -1) for gate_kernel in np.hsplit(kernel, gate_nr)]
+    recurrent_kernels = [gate_kernel.reshape(UNIT_NR, UNIT_NR) for gate_kernel in np.hsplit(recurrent_kernel, gate_nr)]
+    return kernels, recurrent_kernels
+
+
+def _cudnn_gru_reference(x, kernel, recurrent_kernel, bias):
+    (W_z, W_r, W_h), (R_z, R_r, R_h) = _cudnn_gates(kernel, recurrent_kernel, 3)
+    (b_z, b_r, b_h), (rb_z, rb_r, rb_h) = [np.split(b, 3) for b in np.split(bias, 2)]
+    h = np.zeros(UNIT_NR)
+    for x_t in x:
+        z = _sigmoid(W_z.dot(x_t) + b_z + R_z.dot(h) + rb_z)
+        r = _sigmoid(W_r.dot(x_t) + b_r + R_r.dot(h) + rb_r)
+        h_candidate = np.tanh(W_h.dot(x_t) + b_h + r * (R_h.dot(h) + rb_h))
+        h = z * h + (1 - z) * h_candidate
+    return h
+
+
+def _cudnn_lstm_reference(x, kernel, recurrent_kernel, bias):
+    kernels, recurrent_kernels = _cudnn_gates(kernel, recurrent_kernel, 4)
+    biases = np.split(bias[:4 * UNIT_NR] + bias[4 * UNIT_NR:], 4)
+    h, c = np.zeros(UNIT_NR), np.zeros(UNIT_NR)
+    for x_t in x:
+        i, f, c_candidate, o = [W.dot(x_t) + R.dot(h) + b for W, R, b in zip(kernels, recurrent_kernels, biases)]
+        c = _sigmoid(f) * c + _sigmoid(i) * np.tanh(c_candidate)
+        h = _sigmoid(o) * np.tanh(c)
+    return h
+
+
+@pytest.mark.parametrize('layer_class, gate_nr, reference', [
+    (lambda: GRU(UNIT_NR, recurrent_activation='sigmoid', reset_after=True), 3, _cudnn_gru_reference),
+    (lambda: LSTM(UNIT_NR, recurrent_activation='sigmoid'), 4, _cudnn_lstm_reference),
+])
+def test_converted_weights_reproduce_cudnn_equations(layer_class, gate_nr, reference):
+    rng = np.random.RandomState(0)
+    x = rng.randn(2, TIMESTEP_NR, INPUT_DIM).astype(np.float32)
+    cudnn_weights = [rng.randn(INPUT_DIM, gate_nr * UNIT_NR),
+                     rng.randn(UNIT_NR, gate_nr * UNIT_NR),
+                     rng.randn(2 * gate_nr * UNIT_NR)]
+
+    K.clear_session()
+    input_sequence = Input(shape=(TIMESTEP_NR, INPUT_DIM))
+    layer = layer_class()
+    model = Model(inputs=input_sequence, outputs=layer(input_sequence))
+    layer.set_weights(convert_rnn_weights(layer, cudnn_weights))
+
+    expected = np.stack([reference(x_i, *cudnn_weights) for x_i in x])
+    np.testing.assert_allclose(model.predict(x), expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('build_model', [cudnn_gru, cudnn_lstm])
+def test_cpu_model_loads_converted_cudnn_weights(build_model, tmpdir):
+    filepath = str(tmpdir.join('cudnn_model.h5'))
+    rng = np.random.RandomState(0)
+
+    K.clear_session()
+    cudnn_model = build_model(**MODEL_PARAMS, rnn_backend='cudnn')
+    cudnn_weights = [rng.randn(*weight.shape).astype(np.float32) for weight in cudnn_model.get_weights()]
+    cudnn_model.set_weights(cudnn_weights)
+    cudnn_model.save_weights(filepath)
+    cudnn_layer_weights = [layer.get_weights() for layer in cudnn_model.layers if layer.weights]
+
+    K.clear_session()
+    cpu_model = build_model(**MODEL_PARAMS, rnn_backend='cpu', rnn_unroll=True)
+    load_converted_weights(cpu_model, filepath)
+
+    cpu_layers = [layer for layer in cpu_model.layers if layer.weights]
+    assert len(cpu_layers) == len(cudnn_layer_weights)
+    for layer, weights in zip(cpu_layers, cudnn_layer_weights):
+        for loaded_weight, expected_weight in zip(layer.get_weights(), convert_rnn_weights(layer, weights)):
+            np.testing.assert_allclose(loaded_weight, expected_weight)
+
+    X = rng.randint(1, MODEL_PARAMS['max_features'], (3, MODEL_PARAMS['maxlen']))
+    assert np.isfinite(cpu_model.predict(X)).all()
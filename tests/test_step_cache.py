@@ -0,0 +1,166 @@
+import os
+
+import numpy as np
+import pytest
+from sklearn.externals import joblib
+
+from steps.base import Step, BaseTransformer, to_tuple_inputs
+from steps.executor import Executor
+
+
+class MeanCenterer(BaseTransformer):
+    chunkable = True
+
+    def __init__(self, config):
+        self.config = config
+
+    def fit(self, X):
+        self.mean = X.mean()
+        return self
+
+    def fit_partial(self, X):
+        self.chunk_means = getattr(self, 'chunk_means', []) + [X.mean()]
+        return self
+
+    def finish_partial_fit(self):
+        self.mean = np.mean(self.chunk_means)
+        return self
+
+    def transform(self, X):
+        return {'X': X - self.mean}
+
+    def save(self, filepath):
+        joblib.dump(self.mean, filepath)
+
+    def load(self, filepath):
+        self.mean = joblib.load(filepath)
+        return self
+
+
+def _centering_pipeline(config, cache_dirpath):
+    first = Step(name='first',
+                 transformer=MeanCenterer(config),
+                 input_data=['input'],
+                 adapter={'X': ([('input', 'X')])},
+                 cache_dirpath=cache_dirpath)
+    return Step(name='second',
+                transformer=MeanCenterer(config),
+                input_steps=[first],
+                cache_dirpath=cache_dirpath)
+
+
+def test_transform_uses_transformer_fitted_on_train_data(tmpdir):
+    config = {'param': 1}
+    train = {'input': {'X': np.arange(4.0)}}
+    test = {'input': {'X': np.zeros(2)}}
+
+    _centering_pipeline(config, str(tmpdir)).fit_transform(train)
+    output = _centering_pipeline(config, str(tmpdir)).transform(test)
+
+    np.testing.assert_allclose(output['X'], [-1.5, -1.5])
+
+
+def test_refit_on_new_train_data(tmpdir):
+    config = {'param': 1}
+    _centering_pipeline(config, str(tmpdir)).fit_transform({'input': {'X': np.arange(4.0)}})
+    _centering_pipeline(config, str(tmpdir)).fit_transform({'input': {'X': np.arange(4.0) + 10}})
+    output = _centering_pipeline(config, str(tmpdir)).transform({'input': {'X': np.zeros(2)}})
+
+    np.testing.assert_allclose(output['X'], [-11.5, -11.5])
+
+
+def test_evicted_transformers_lose_their_records(tmpdir):
+    _centering_pipeline({'param': 1}, str(tmpdir)).fit_transform({'input': {'X': np.arange(4.0)}})
+    pipeline = _centering_pipeline({'param': 2}, str(tmpdir))
+    pipeline.fit_transform({'input': {'X': np.arange(4.0)}}, cache_size_limit=1)
+
+    transformer_filenames = sorted(os.listdir(str(tmpdir.join('transformers'))))
+    assert transformer_filenames == sorted(os.path.basename(step.cache_filepath_step_transformer)
+                                           for step in pipeline.all_steps.values())
+    for filename in os.listdir(str(tmpdir.join('transformer_keys'))):
+        step_name = filename.rsplit('_', 1)[0]
+        recorded_key = joblib.load(str(tmpdir.join('transformer_keys', filename)))
+        assert '{}_{}'.format(step_name, recorded_key) in transformer_filenames
+    with pytest.raises(ValueError, match='No transformer cached'):
+        _centering_pipeline({'param': 1}, str(tmpdir)).transform({'input': {'X': np.zeros(2)}})
+
+
+def test_frozen_step_keeps_transformer_fitted_on_chunks(tmpdir):
+    config = {'param': 1}
+    pipeline = _centering_pipeline(config, str(tmpdir))
+    Executor().fit_stream([pipeline.get_step('first')],
+                          lambda: iter([{'input': {'X': np.full(2, 100.0)}}, {'input': {'X': np.full(2, 102.0)}}]))
+
+    pipeline = _centering_pipeline(config, str(tmpdir))
+    pipeline.get_step('first').freeze_transformer = True
+    pipeline.fit_transform({'input': {'X': np.arange(4.0)}})
+
+    assert pipeline.get_step('first').transformer.mean == 101.0
+    assert pipeline.get_step('second').transformer.mean == -99.5
+
+
+def test_transform_after_embedding_model_fit(tmpdir):
+    pytest.importorskip('keras')
+    from models import PretrainedEmbeddingModel
+
+    class ConstantModel:
+        def __init__(self, prediction=None):
+            self.prediction = prediction
+
+        def fit(self, X, y, **kwargs):
+            self.prediction = y.mean(axis=0)
+
+        def predict(self, X, **kwargs):
+            return np.tile(self.prediction, (len(X), 1))
+
+    class ConstantClassifier(PretrainedEmbeddingModel):
+        def _create_callbacks(self, **kwargs):
+            return []
+
+        def _compile_model(self, model_params, optimizer_params):
+            return ConstantModel()
+
+        def save(self, filepath):
+            joblib.dump(self.model.prediction, filepath)
+
+        def load(self, filepath):
+            self.model = ConstantModel(joblib.load(filepath))
+            return self
+
+    class EmbeddingsSource(BaseTransformer):
+        def transform(self, X):
+            return {'embeddings_matrix': np.ones((3, 2))}
+
+        def save(self, filepath):
+            joblib.dump({}, filepath)
+
+        def load(self, filepath):
+            return self
+
+    config = {'architecture_config': {'model_params': {'maxlen': 10}, 'optimizer_params': {}},
+              'training_config': {},
+              'callbacks_config': {}}
+
+    def pipeline():
+        embeddings = Step(name='embeddings',
+                          transformer=EmbeddingsSource(),
+                          input_data=['input'],
+                          adapter={'X': ([('input', 'X')])},
+                          cache_dirpath=str(tmpdir))
+        return Step(name='classifier',
+                    transformer=ConstantClassifier(**config),
+                    input_steps=[embeddings],
+                    input_data=['input'],
+                    adapter={'embedding_matrix': ([('embeddings', 'embeddings_matrix')]),
+                             'X': ([('input', 'X')]),
+                             'y': ([('input', 'y')]),
+                             'validation_data': ([('input', 'X'), ('input', 'y')], to_tuple_inputs),
+                             },
+                    cache_dirpath=str(tmpdir))
+
+    y = np.array([[0.0, 1.0], [1.0, 1.0]])
+    pipeline().fit_transform({'input': {'X': np.zeros((2, 10)), 'y': y}})
+    assert 'embedding_matrix' not in config['architecture_config']['model_params']
+
+    output = pipeline().transform({'input': {'X': np.zeros((3, 10)), 'y': None}})
+    np.testing.assert_allclose(output['prediction_probability'], [[0.5, 1.0]] * 3)
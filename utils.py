@@ -50,6 +50,12 @@ def read_data(data_dir, filename):
     return meta_data
 
 
+def read_data_chunks(data_dir, filename, chunksize):
+    meta_filepath = os.path.join(data_dir, filename)
+    for meta_chunk in pd.read_csv(meta_filepath, chunksize=chunksize):
+        yield meta_chunk.reset_index(drop=True)
+
+
 def read_predictions(prediction_dir, mode='valid', valid_columns=None, stacking_mode='flat'):
     valid_labels = pd.read_csv(os.path.join(prediction_dir, 'valid_split.csv'))
     sample_submission = pd.read_csv(os.path.join(prediction_dir, 'sample_submission.csv'))